@@ -1,2 +1,25 @@
-from xeno import provide, inject, singleton
-from .core import *
+# The bulk of Bakery, along with xeno, is only imported when one of
+# its names is first used, e.g. by 'from bakery import *' in a Bakefile,
+# so that 'bake' can finish a no-op build without importing it at all.
+
+import importlib as _importlib
+
+_loaded = False
+
+#--------------------------------------------------------------------
+def _load():
+    global _loaded, __all__
+    _loaded = True
+    xeno = _importlib.import_module('xeno')
+    core = _importlib.import_module('bakery.core')
+    names = {name: value for name, value in vars(core).items() if not name.startswith('_')}
+    names.update(provide = xeno.provide, inject = xeno.inject, singleton = xeno.singleton)
+    globals().update(names)
+    __all__ = sorted(names)
+
+#--------------------------------------------------------------------
+def __getattr__(name):
+    if _loaded or (name.startswith('__') and name != '__all__'):
+        raise AttributeError("module 'bakery' has no attribute '%s'" % name)
+    _load()
+    return __getattr__(name) if name not in globals() else globals()[name]
@@ -5,19 +5,72 @@
 # Date: Friday, April 7th 2017
 #--------------------------------------------------------------------
 
+import hashlib
+import importlib.util
+import marshal
 import os
 import sys
+import time
 
-from .log import BuildLog
+from .fastpath import is_up_to_date, remove_manifest
+from .log import BuildLog, LogWriter
 
 #--------------------------------------------------------------------
 BAKEFILE_NAME = 'Bakefile.py'
+BYTECODE_CACHE_DIR = '.bakery'
+BYTECODE_CACHE_NAME = 'Bakefile.pyc'
 PREAMBLE = """
 from bakery import *
 from bakery.core import Build
 Build.global_config.parse_args()
 """
 
+#--------------------------------------------------------------------
+def read_bakefile(bakefile_name):
+    """
+        Returns the source of the PREAMBLE followed by the given
+        Bakefile, and the hex digest of that source.
+    """
+    with open(bakefile_name, 'rb') as infile:
+        source = PREAMBLE.encode('utf-8') + infile.read()
+    return source, hashlib.sha256(source).hexdigest()
+
+#--------------------------------------------------------------------
+def load_bakefile(bakefile_name, source, digest):
+    """
+        Returns the code object for the given Bakefile source, and
+        whether it was loaded from the bytecode cache.  The cache
+        holds the most recently compiled Bakefile and is keyed by
+        the digest of its source and the Python bytecode version, so
+        it is simply recompiled when either changes.
+    """
+    key = importlib.util.MAGIC_NUMBER + bytes.fromhex(digest)
+    cache_filename = os.path.join(BYTECODE_CACHE_DIR, BYTECODE_CACHE_NAME)
+
+    try:
+        with open(cache_filename, 'rb') as infile:
+            if infile.read(len(key)) == key:
+                return marshal.loads(infile.read()), True
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    code = compile(source, bakefile_name, 'exec')
+    try:
+        os.makedirs(BYTECODE_CACHE_DIR, exist_ok = True)
+        tmp_filename = '%s.%d.tmp' % (cache_filename, os.getpid())
+        with open(tmp_filename, 'wb') as outfile:
+            outfile.write(key + marshal.dumps(code))
+        os.replace(tmp_filename, cache_filename)
+    except OSError:
+        pass
+    return code, False
+
+#--------------------------------------------------------------------
+def print_startup_profile(timings):
+    sys.stderr.write('Startup profile:\n')
+    for name, seconds in timings:
+        sys.stderr.write('    %-24s %8.1f ms\n' % (name, seconds * 1000))
+
 #--------------------------------------------------------------------
 def main():
     """
@@ -25,6 +78,10 @@ def main():
         Prepends the PREAMBLE source to the contents of 'Bakefile.py'
         in the current directory, or the file specified by the '-b'
         command line switch, and executes the resulting script.
+
+        If the last run with the same Bakefile and arguments was a
+        no-op and none of the files it depended on have changed since,
+        exits without loading the Bakefile at all.
     """
     bakefile_name = BAKEFILE_NAME
     if '-b' in sys.argv and len(sys.argv) > sys.argv.index('-b'):
@@ -34,12 +91,39 @@ def main():
         print('FATAL: No %s in the current directory.' % bakefile_name)
         sys.exit(1)
 
-    bake_instructions = PREAMBLE + open(bakefile_name).read()
+    started = time.perf_counter()
+    source, digest = read_bakefile(bakefile_name)
+    # A profiled build is always loaded, so that there is something to profile.
+    fast_path = not any(arg in sys.argv for arg in ('--no-fast-path', '--profile', '--profile-json'))
+    if fast_path and is_up_to_date(digest, sys.argv[1:]):
+        LogWriter.get().configure(quiet = '-q' in sys.argv or '--quiet' in sys.argv)
+        BuildLog.get(main).success('BUILD SUCCEEDED (nothing to do)')
+        if '--startup-profile' in sys.argv:
+            print_startup_profile([('no-op fast path', time.perf_counter() - started)])
+        return
+    remove_manifest()
+
+    from .core import Build
+    Build.global_config.bakefile_digest = digest
+    imported = time.perf_counter()
 
-    exec(bake_instructions, globals())
+    code, cached = load_bakefile(bakefile_name, source, digest)
+    loaded = time.perf_counter()
+
+    exec(code, globals())
+    finished = time.perf_counter()
 
     if Build.build_count == 0:
         BuildLog.get(main, log = False).warning('Nothing was built, did you forget to call build() with modules?')
+    elif fast_path:
+        Build.noop_manifest.save(digest, sys.argv[1:])
+
+    if '--startup-profile' in sys.argv:
+        print_startup_profile([
+            ('import bakery', imported - started),
+            ('load Bakefile (%s)' % ('cached' if cached else 'compiled'), loaded - imported),
+            ('run Bakefile and build', finished - loaded)
+        ])
 
 #--------------------------------------------------------------------
 if __name__ == '__main__':
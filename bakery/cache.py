@@ -0,0 +1,468 @@
+#--------------------------------------------------------------------
+# bakery.cache: Content addressed caches of build outputs.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+import uuid
+import zlib
+import lzma
+
+from .error import BuildError
+from .work import command_line, shell_output
+
+#--------------------------------------------------------------------
+DEFAULT_CACHE_DIR = '~/.cache/bakery'
+DEFAULT_MAX_SIZE = 5 * 1024 ** 3
+
+#--------------------------------------------------------------------
+_compiler_identities = {}
+
+#--------------------------------------------------------------------
+def compiler_identity(compiler):
+    """
+        Returns a string identifying the given compiler, composed of
+        its resolved path and its '--version' output.  The result is
+        memoized for the lifetime of the process.
+    """
+    if compiler not in _compiler_identities:
+        path = shutil.which(compiler) or compiler
+        version = shell_output(compiler, '--version').decode('utf-8', 'replace')
+        _compiler_identities[compiler] = '%s\n%s' % (os.path.realpath(path), version)
+    return _compiler_identities[compiler]
+
+#--------------------------------------------------------------------
+def cache_key(*parts):
+    """
+        Returns a hex digest uniquely identifying the given parts,
+        which must be JSON serializable.
+    """
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+#--------------------------------------------------------------------
+def compile_key(compiler, flags, src, depfile = None):
+    """
+        Returns the cache key for compiling the given source file with
+        the given compiler and flags.  The source is run through the
+        preprocessor so that changes to any included header produce a
+        different key.  If 'depfile' is given, the preprocessor also
+        writes the source's dependencies to it, so that the depfile
+        lists this checkout's headers even when the object comes from
+        a cache filled by another checkout.
+    """
+    flags = command_line(flags)
+    depfile_flags = ['-MMD', '-MF', depfile] if depfile is not None else []
+    preprocessed = shell_output(compiler, flags, depfile_flags, '-E', src, response_file = True)
+    return cache_key(compiler_identity(compiler), flags, hashlib.sha256(preprocessed).hexdigest())
+
+#--------------------------------------------------------------------
+class CacheError(BuildError):
+    pass
+
+#--------------------------------------------------------------------
+class Cache:
+    """
+        Base class for caches of build outputs.  Subclasses implement
+        'fetch()' and 'store()' for a list of output Files.
+    """
+    def fetch(self, key, outputs):
+        raise NotImplementedError()
+
+    def store(self, key, outputs):
+        raise NotImplementedError()
+
+    def run(self, key, outputs, build):
+        """
+            Materialize the outputs for the given key from the cache,
+            or remove any stale outputs, call 'build()' to produce them
+            and store them in the cache.  Returns True on a hit.
+        """
+        if self.fetch(key, outputs):
+            return True
+        for f in outputs:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(f.abspath())
+            f.invalidate()
+        build()
+        self.store(key, outputs)
+        return False
+
+#--------------------------------------------------------------------
+class ObjectCache(Cache):
+    """
+        A ccache-like local cache of compiler outputs.  Entries are
+        keyed by the compiler's identity, its flags and a hash of the
+        preprocessed source, and hold every output file of the
+        compilation (e.g. the object file and its depfile).
+
+        Hits are materialized by hard link where possible, falling
+        back to a copy.  Outputs are removed before the compiler is
+        run on a miss so that it never writes through a hard link into
+        the cache.  When the cache grows beyond 'max_size' bytes, the
+        least recently used entries are evicted.
+
+        Hit, miss and size counters are kept in 'stats.json' in the
+        cache directory, see 'python -m bakery.cache'.
+    """
+    def __init__(self, path = None, max_size = None, hardlink = True):
+        if path is None:
+            path = os.environ.get('BAKERY_CACHE_DIR', DEFAULT_CACHE_DIR)
+        if max_size is None:
+            max_size = int(os.environ.get('BAKERY_CACHE_SIZE', DEFAULT_MAX_SIZE))
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_size = max_size
+        self.hardlink = hardlink
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def fetch(self, key, outputs):
+        """
+            Materialize the cached outputs for the given key into the
+            given list of Files.  Returns True on a hit.
+        """
+        entry = self.entry_path(key)
+        names = [os.path.basename(f.abspath()) for f in outputs]
+        if not all(os.path.exists(os.path.join(entry, name)) for name in names):
+            self._update_stats(misses = 1)
+            return False
+
+        try:
+            for f, name in zip(outputs, names):
+                self._materialize(os.path.join(entry, name), f.abspath())
+                f.invalidate()
+        except FileNotFoundError:
+            # The entry was evicted by another process while we read it.
+            self._update_stats(misses = 1)
+            return False
+        with contextlib.suppress(OSError):
+            os.utime(entry)
+        self._update_stats(hits = 1)
+        return True
+
+    def store(self, key, outputs):
+        """
+            Store the given list of output Files under the given key.
+            The entry is assembled in a temporary directory and renamed
+            into place so that it is never seen half written.
+        """
+        entry = self.entry_path(key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok = True)
+        tmp_entry = '%s.%d.tmp' % (entry, os.getpid())
+        shutil.rmtree(tmp_entry, ignore_errors = True)
+        os.makedirs(tmp_entry)
+        size = 0
+        for f in outputs:
+            dest = os.path.join(tmp_entry, os.path.basename(f.abspath()))
+            shutil.copyfile(f.abspath(), dest)
+            os.chmod(dest, 0o444)
+            size += os.path.getsize(dest)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another process stored the same entry first.
+            shutil.rmtree(tmp_entry, ignore_errors = True)
+            return
+        if self._update_stats(size = size)['size'] > self.max_size:
+            self.evict()
+
+    def evict(self, target_size = None):
+        """
+            Remove the least recently used entries until the cache is
+            no larger than 'target_size', by default 90% of 'max_size'.
+        """
+        if target_size is None:
+            target_size = int(self.max_size * 0.9)
+        with self._locked():
+            entries = []
+            for entry in self._entries():
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            total_size = sum(size for mtime, size, entry in entries)
+            for mtime, size, entry in sorted(entries):
+                if total_size <= target_size:
+                    break
+                shutil.rmtree(entry, ignore_errors = True)
+                total_size -= size
+            stats = self._read_stats()
+            stats['size'] = total_size
+            self._write_stats(stats)
+
+    def clear(self):
+        self.evict(target_size = 0)
+
+    def stats(self):
+        with self._locked():
+            return self._read_stats()
+
+    def _materialize(self, src, dest):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(dest)
+        if self.hardlink:
+            try:
+                os.link(src, dest)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(src, dest)
+
+    def _entries(self):
+        if not os.path.isdir(self.path):
+            return
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_path):
+                continue
+            for name in os.listdir(prefix_path):
+                if not name.endswith('.tmp'):
+                    yield os.path.join(prefix_path, name)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(self.path, exist_ok = True)
+        with open(os.path.join(self.path, 'lock'), 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _read_stats(self):
+        stats = {'hits': 0, 'misses': 0, 'size': 0}
+        try:
+            with open(os.path.join(self.path, 'stats.json'), 'r') as infile:
+                stats.update(json.load(infile))
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    def _write_stats(self, stats):
+        tmp_filename = os.path.join(self.path, 'stats.json.%d.tmp' % os.getpid())
+        with open(tmp_filename, 'w') as outfile:
+            json.dump(stats, outfile)
+        os.replace(tmp_filename, os.path.join(self.path, 'stats.json'))
+
+    def _update_stats(self, **deltas):
+        with self._locked():
+            stats = self._read_stats()
+            for key, delta in deltas.items():
+                stats[key] += delta
+            self._write_stats(stats)
+            return stats
+
+#--------------------------------------------------------------------
+class SharedCache(Cache):
+    """
+        A cache of build outputs in a directory which may be shared
+        by many concurrent 'bake' processes on different hosts, e.g.
+        over NFS.
+
+        Every entry is a single self-describing blob holding all of
+        the outputs for a key.  Blobs are written to a private
+        temporary file and published with an atomic rename, so readers
+        never take locks and always see either no blob or a complete
+        one.  Each blob records the SHA-256 of every member and of its
+        whole payload, which are verified on every read.  A corrupt
+        blob is treated as a miss and removed.  Members may be stored
+        uncompressed or compressed with 'zlib' or 'lzma'.
+
+        Hit, miss and corruption counts are kept per process in
+        'hits', 'misses' and 'corrupt' to avoid contention on the
+        shared directory.
+    """
+    MAGIC = b'BAKERY-BLOB-1\n'
+    COMPRESSORS = {
+        'none': (lambda data: data, lambda data: data),
+        'zlib': (zlib.compress, zlib.decompress),
+        'lzma': (lzma.compress, lzma.decompress)
+    }
+
+    def __init__(self, path, compression = 'zlib'):
+        if compression not in SharedCache.COMPRESSORS:
+            raise CacheError('Unknown compression "%s", expected one of: %s' % (
+                compression, ', '.join(sorted(SharedCache.COMPRESSORS))))
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.compression = compression
+        self.hits = 0
+        self.misses = 0
+        self.corrupt = 0
+
+    def blob_path(self, key):
+        return os.path.join(self.path, 'objects', key[:2], key)
+
+    def fetch(self, key, outputs):
+        """
+            Materialize the cached outputs for the given key into the
+            given list of Files.  Returns True on a hit.
+        """
+        blob_path = self.blob_path(key)
+        try:
+            with open(blob_path, 'rb') as infile:
+                members = self.unpack(infile.read())
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        except (OSError, CacheError):
+            self.corrupt += 1
+            self.misses += 1
+            with contextlib.suppress(OSError):
+                os.unlink(blob_path)
+            return False
+
+        names = [os.path.basename(f.abspath()) for f in outputs]
+        if not all(name in members for name in names):
+            self.misses += 1
+            return False
+
+        for f, name in zip(outputs, names):
+            data, mode = members[name]
+            self._write_atomically(f.abspath(), data, mode)
+            f.invalidate()
+        with contextlib.suppress(OSError):
+            os.utime(blob_path)
+        self.hits += 1
+        return True
+
+    def store(self, key, outputs):
+        """
+            Publish the given list of output Files under the given key.
+        """
+        members = []
+        for f in outputs:
+            with open(f.abspath(), 'rb') as infile:
+                mode = os.fstat(infile.fileno()).st_mode & 0o777
+                members.append((os.path.basename(f.abspath()), infile.read(), mode))
+        self._write_atomically(self.blob_path(key), self.pack(members))
+
+    def pack(self, members):
+        """
+            Pack the given list of (name, data, mode) tuples into a blob.
+        """
+        compress, _ = SharedCache.COMPRESSORS[self.compression]
+        header = {'compression': self.compression, 'members': []}
+        payload = []
+        for name, data, mode in members:
+            packed = compress(data)
+            header['members'].append({
+                'name': name,
+                'mode': mode,
+                'size': len(data),
+                'length': len(packed),
+                'sha256': hashlib.sha256(data).hexdigest()
+            })
+            payload.append(packed)
+        payload = b''.join(payload)
+        header['sha256'] = hashlib.sha256(payload).hexdigest()
+        return SharedCache.MAGIC + json.dumps(header).encode('utf-8') + b'\n' + payload
+
+    def unpack(self, blob):
+        """
+            Unpack and verify a blob, returning a map of member names
+            to (data, mode) pairs.  Raises CacheError if the blob is corrupt.
+        """
+        if not blob.startswith(SharedCache.MAGIC):
+            raise CacheError('Invalid blob header.')
+        header_end = blob.find(b'\n', len(SharedCache.MAGIC))
+        if header_end < 0:
+            raise CacheError('Truncated blob header.')
+        try:
+            header = json.loads(blob[len(SharedCache.MAGIC):header_end].decode('utf-8'))
+            _, decompress = SharedCache.COMPRESSORS[header['compression']]
+        except (ValueError, KeyError) as e:
+            raise CacheError('Invalid blob header: %s' % str(e))
+
+        payload = blob[header_end + 1:]
+        if hashlib.sha256(payload).hexdigest() != header['sha256']:
+            raise CacheError('Blob payload checksum mismatch.')
+
+        members = {}
+        offset = 0
+        for member in header['members']:
+            try:
+                data = decompress(payload[offset:offset + member['length']])
+            except (zlib.error, lzma.LZMAError) as e:
+                raise CacheError('Unable to decompress "%s": %s' % (member['name'], str(e)))
+            if len(data) != member['size'] or hashlib.sha256(data).hexdigest() != member['sha256']:
+                raise CacheError('Checksum mismatch for "%s".' % member['name'])
+            members[member['name']] = (data, member['mode'])
+            offset += member['length']
+        return members
+
+    def prune(self, max_size):
+        """
+            Remove the least recently used blobs until the cache is no
+            larger than 'max_size' bytes.  Safe to run while other
+            processes are reading and writing the cache.
+        """
+        blobs = []
+        objects_path = os.path.join(self.path, 'objects')
+        for dirpath, dirnames, filenames in os.walk(objects_path):
+            for filename in filenames:
+                with contextlib.suppress(OSError):
+                    st = os.stat(os.path.join(dirpath, filename))
+                    blobs.append((st.st_mtime, st.st_size, os.path.join(dirpath, filename)))
+        total_size = sum(size for mtime, size, filename in blobs)
+        for mtime, size, filename in sorted(blobs):
+            if total_size <= max_size:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(filename)
+            total_size -= size
+
+    def _write_atomically(self, filename, data, mode = 0o644):
+        tmp_dir = os.path.join(self.path, 'tmp')
+        if not filename.startswith(self.path + os.sep):
+            tmp_dir = os.path.dirname(filename)
+        os.makedirs(tmp_dir, exist_ok = True)
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        tmp_filename = os.path.join(tmp_dir, '.%s.%s.%d.%d.%s.tmp' % (
+            os.path.basename(filename), socket.gethostname(), os.getpid(),
+            threading.get_ident(), uuid.uuid4().hex))
+        try:
+            with open(tmp_filename, 'wb') as outfile:
+                outfile.write(data)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.chmod(tmp_filename, mode)
+            os.replace(tmp_filename, filename)
+        except Exception:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_filename)
+            raise
+
+#--------------------------------------------------------------------
+def main():
+    """
+        Show statistics for or clear a local ObjectCache.
+    """
+    parser = argparse.ArgumentParser(description = 'Manage the Bakery object cache.')
+    parser.add_argument('path', nargs='?', default=None)
+    parser.add_argument('-C', '--clear', action='store_true')
+    args = parser.parse_args()
+
+    cache = ObjectCache(args.path)
+    if args.clear:
+        cache.clear()
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    print('cache directory: %s' % cache.path)
+    print('hits:            %d' % stats['hits'])
+    print('misses:          %d' % stats['misses'])
+    print('hit rate:        %.1f%%' % (100.0 * stats['hits'] / lookups if lookups else 0.0))
+    print('size:            %.1f MB / %.1f MB' % (stats['size'] / 1024 ** 2, cache.max_size / 1024 ** 2))
+
+#--------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ import functools
 import logging
 import os
 import sys
+import time
 import xeno
 
 from .evaluate import *
@@ -20,7 +21,15 @@ from .file import *
 from .work import *
 from .log import *
 from .error import *
-from .parallel import get_process_pool
+from .parallel import WorkerPool, get_process_pool, configure_process_pool, shutdown_process_pool
+from .fscache import stat_cache
+from .graph import GraphCache
+from .fastpath import NoopManifest
+from .trace import start_tracing, get_tracer, trace_span
+from .profile import BuildProfile, PROFILE_FILENAME, children_cpu_time
+from .cache import SharedCache
+from .engine import set_engine_limit
+from .jobserver import setup_jobserver
 
 #--------------------------------------------------------------------
 def _decorate(tag, f):
@@ -44,6 +53,23 @@ class Config:
         self.clean = False
         self.parallel = False
         self.recursive_clean = False
+        self.jobs = None
+        self.workers = os.environ.get('BAKERY_WORKERS')
+        self.shared_cache = os.environ.get('BAKERY_SHARED_CACHE')
+        self.shared_cache_compression = 'zlib'
+        self.jobserver = os.environ.get('BAKERY_JOBSERVER', 'pipe')
+        self.pool = os.environ.get('BAKERY_POOL', 'process')
+        self.chunksize = 1
+        self.startup_profile = False
+        self.graph_cache = True
+        self.fast_path = True
+        self.trace = None
+        self.profile = False
+        self.profile_top = 10
+        self.profile_json = None
+        self.quiet = False
+        self.log_json = None
+        self.bakefile_digest = None
 
     def get_arg_parser(self):
         parser = argparse.ArgumentParser(description = 'Execute targets in bakefiles.')
@@ -51,13 +77,43 @@ class Config:
         parser.add_argument('-D', '--debug', action='store_true')
         parser.add_argument('-c', '--clean', action='store_true')
         parser.add_argument('-p', '--parallel', action='store_true')
+        parser.add_argument('-j', '--jobs', type=int)
         parser.add_argument('-R', '--recursive-clean', action='store_true')
         parser.add_argument('-b', '--bakefile')
+        parser.add_argument('-q', '--quiet', action='store_true')
+        parser.add_argument('--log-json', metavar='FILE')
+        parser.add_argument('-w', '--workers', metavar='HOST:PORT,...')
+        parser.add_argument('--shared-cache', metavar='DIR')
+        parser.add_argument('--shared-cache-compression', choices=sorted(SharedCache.COMPRESSORS))
+        parser.add_argument('--jobserver', choices=['pipe', 'fifo', 'off'])
+        parser.add_argument('--pool', choices=WorkerPool.BACKENDS)
+        parser.add_argument('--chunksize', type=int, metavar='N')
+        parser.add_argument('--startup-profile', action='store_true')
+        parser.add_argument('--no-graph-cache', dest='graph_cache', action='store_false')
+        parser.add_argument('--no-fast-path', dest='fast_path', action='store_false')
+        parser.add_argument('--trace', metavar='FILE')
+        parser.add_argument('--profile', action='store_true')
+        parser.add_argument('--profile-top', type=int, metavar='N')
+        parser.add_argument('--profile-json', metavar='FILE')
         return parser
 
     def is_debug(self):
         return int(os.environ.get('BAKERY_DEBUG', "0")) or self.debug
 
+    def get_jobs(self):
+        """
+            The number of targets to evaluate at once.  Defaults to the
+            number of local processors plus the capacity of any remote
+            workers.
+        """
+        if self.jobs:
+            return self.jobs
+        executor = None
+        if self.workers:
+            from .remote import get_executor
+            executor = get_executor()
+        return (os.cpu_count() or 1) + (executor.capacity() if executor else 0)
+
     def is_cleaning(self):
         return self.clean
 
@@ -92,7 +148,8 @@ class TaskDeciderBase(EvaluationDecider):
         """
         attrs = injector.get_resource_attributes(target)
         if attrs.check('singleton'):
-            singleton = injector.require(target)
+            with trace_span(target, 'resolve'):
+                singleton = injector.require(target)
             injector.unbind_singleton(target)
             return singleton
         else:
@@ -120,6 +177,27 @@ class TaskDeciderBase(EvaluationDecider):
         else:
             return None
 
+    def get_evaluation_set(self, injector, targets, dep_graph, order = None):
+        """
+            Determine the set of targets which need to be evaluated in
+            a single pass over the dependency graph, visiting each
+            target exactly once after all of its dependents.  A target
+            is 'wanted' if any target depending on it, directly or
+            transitively, is being evaluated.  'order' may give a
+            precomputed dependents-first order of the graph.
+        """
+        eval_set = set()
+        wanted = set()
+        for target in order or dependents_first(dep_graph):
+            if self.needs_evaluation(injector, target, target in wanted):
+                eval_set.add(target)
+            if target in eval_set or target in wanted:
+                wanted.update(dep_graph[target])
+        return eval_set
+
+    def needs_evaluation(self, injector, target, wanted):
+        raise NotImplementedError()
+
     def is_temp(self, injector, target):
         """
             Determine if the given target is flagged as temporary.
@@ -129,44 +207,51 @@ class TaskDeciderBase(EvaluationDecider):
 
 #--------------------------------------------------------------------
 class BuildTaskDecider(TaskDeciderBase):
-    def get_evaluation_set(self, injector, target, higher_eval_set = None):
-        task = self.get_actionable(injector, target)
-        if not task or task.is_done() or (self.is_temp(injector, target) and not higher_eval_set):
-            eval_set = higher_eval_set or set()
-        else:
-            eval_set = {target} | (higher_eval_set or set())
-        
-        for dep in injector.get_dependencies(target):
-            eval_set |= self.get_evaluation_set(injector, dep, eval_set)
+    def __init__(self):
+        super().__init__()
+        # Every actionable in the graph, whether or not it needs to be
+        # evaluated, for recording the inputs of no-op builds.
+        self.actionables = []
 
-        return eval_set
+    def needs_evaluation(self, injector, target, wanted):
+        task = self.get_actionable(injector, target)
+        if task:
+            self.actionables.append(task)
+        if self.is_temp(injector, target) and not wanted:
+            return False
+        if not task:
+            return False
+        with trace_span(target, 'check'):
+            return not task.is_done()
 
     def evaluate(self, injector, target):
         BuildLog.get(self).target('Building target \'%s\'...' % target)
-        result = injector.require(target)()
-        injector.provide(target, result, is_singleton = True)
+        with trace_span(target, 'target') as args:
+            with self.lock:
+                task = injector.require(target)
+            args['queue'] = isinstance(task, TaskQueue)
+            with capture_output(target):
+                result = task()
+            with self.lock:
+                injector.provide(target, result, is_singleton = True)
         return result
 
 #--------------------------------------------------------------------
 class CleanupTaskDecider(TaskDeciderBase):
     def __init__(self, config):
+        super().__init__()
         self.config = config
 
-    def get_evaluation_set(self, injector, target, higher_eval_set = None):
+    def needs_evaluation(self, injector, target, wanted):
         cleanable = self.get_cleanable(injector, target)
-        if not cleanable or not cleanable.needs_cleaning(self.config.is_recursive_clean_enabled()):
-            eval_set = higher_eval_set or set()
-        else:
-            eval_set = {target} | (higher_eval_set or set())
-
-        for dep in injector.get_dependencies(target):
-            eval_set |= self.get_evaluation_set(injector, dep, eval_set)
-
-        return eval_set
+        return bool(cleanable) and cleanable.needs_cleaning(self.config.is_recursive_clean_enabled())
 
     def evaluate(self, injector, target):
         BuildLog.get(self).target('Cleaning target \'%s\'...' % target)
-        injector.require(target).clean()
+        with trace_span(target, 'clean'):
+            with self.lock:
+                cleanable = injector.require(target)
+            cleanable.clean()
 
 #--------------------------------------------------------------------
 class Build:
@@ -180,6 +265,7 @@ class Build:
     """
     global_config = Config()
     build_count = 0
+    noop_manifest = NoopManifest()
 
     def __init__(self, config = global_config):
         self.outputs = []
@@ -301,7 +387,22 @@ class Build:
         results = []
         current_target = '<root>'
         Build.build_count += 1
-        required_modules = [m() for m in self._aggregate_required_modules(modules)]
+        stat_cache.clear()
+        LogWriter.get().configure(self.config.quiet, self.config.log_json)
+        profiling = self.config.profile or self.config.profile_json
+        if self.config.trace or profiling:
+            start_tracing(self.config.trace)
+            cpu_start = time.process_time()
+            children_cpu_start = children_cpu_time()
+        if self.config.workers:
+            # Imported here as most builds run locally.
+            from .remote import RemoteExecutor, get_executor, set_executor
+            if get_executor() is None:
+                set_executor(RemoteExecutor(RemoteExecutor.parse_workers(self.config.workers)))
+        if self.config.shared_cache:
+            FileTask.cache = SharedCache(self.config.shared_cache, self.config.shared_cache_compression)
+        module_classes = self._aggregate_required_modules(modules)
+        required_modules = [m() for m in module_classes]
         injector = xeno.Injector(self, *required_modules)
 
         if not self.targets:
@@ -316,36 +417,74 @@ class Build:
             else:
                 raise BuildError('No target was specified and no default target was provided.')
 
+        evaluator = None
         try:
-            evaluator = None
-            if self.config.is_cleaning():
-                evaluator = TaskEvaluator(CleanupTaskDecider(self.config))
-            else:
-                evaluator = TaskEvaluator(BuildTaskDecider())
+            with trace_span('build', 'build'):
+                try:
+                    graph_cache = None
+                    if self.config.graph_cache:
+                        graph_cache = GraphCache.for_build(self.config.bakefile_digest, module_classes, targets)
+                    if self.config.is_cleaning():
+                        evaluator = TaskEvaluator(CleanupTaskDecider(self.config), self.config.get_jobs(), graph_cache)
+                    else:
+                        evaluator = TaskEvaluator(BuildTaskDecider(), self.config.get_jobs(), graph_cache)
             
-            for target in targets:
-                if not target in self.targets:
-                    raise BuildError('Undefined target: "%s"' % target)
+                    for target in targets:
+                        if not target in self.targets:
+                            raise BuildError('Undefined target: "%s"' % target)
+
+                    for setup_resource in self.setup_resources:
+                        injector.require(setup_resource)
+
+                    set_engine_limit(self.config.get_jobs())
+                    setup_jobserver(self.config.get_jobs(), self.config.jobserver)
+                    configure_process_pool(self.config.get_jobs(), self.config.pool, self.config.chunksize)
+                    results = evaluator.evaluate(injector, targets)
+                    if self.config.is_cleaning() or evaluator.eval_set:
+                        Build.noop_manifest.invalidate()
+                    else:
+                        Build.noop_manifest.add_build(evaluator.decider.actionables, module_classes)
+                    BuildLog.get(self).success("BUILD SUCCEEDED")
+        
+                except Exception as e:
+                    Build.noop_manifest.invalidate()
+                    BuildLog.get(self).error("BUILD FAILED (%s): %s" % (current_target, str(e)))
+                    if self.config.is_debug():
+                        raise e
 
-            for setup_resource in self.setup_resources:
-                injector.require(setup_resource)
+                finally:
+                    shutdown_process_pool()
 
-            results = evaluator.evaluate(injector, targets)
-            BuildLog.get(self).success("BUILD SUCCEEDED")
-        
-        except Exception as e:
-            BuildLog.get(self).error("BUILD FAILED (%s): %s" % (current_target, str(e)))
-            if self.config.is_debug():
-                raise e
+                    # Record what was built before temporary outputs are removed.
+                    with trace_span('commit database', 'build'):
+                        BuildDatabase.get().commit()
+
+                    # Clean up all temporary outputs
+                    if not self.config.clean:
+                        with trace_span('clean temporary outputs', 'build'):
+                            for temp_output in self.temp_outputs:
+                                temp_output.clean()
 
         finally:
-            # Clean up all temporary outputs
-            if not self.config.clean:
-                for temp_output in self.temp_outputs:
-                    temp_output.clean()
+            LogWriter.get().flush()
+            if profiling:
+                self._report_profile(evaluator, time.process_time() - cpu_start,
+                                     children_cpu_time() - children_cpu_start)
+            if get_tracer() is not None:
+                get_tracer().save()
 
         return results
     
+    def _report_profile(self, evaluator, cpu, children_cpu):
+        """
+            Print the profile of the build just finished and write it
+            out as JSON, see '--profile'.
+        """
+        profile = BuildProfile(get_tracer().collect(), evaluator.dep_graph if evaluator else None,
+                               self.config.get_jobs(), cpu, children_cpu)
+        profile.print_report(self.config.profile_top)
+        profile.save(self.config.profile_json or PROFILE_FILENAME)
+
     def __call__(self, class_):
         self.build(class_)
         return class_
@@ -0,0 +1,265 @@
+#--------------------------------------------------------------------
+# bakery.db: Persistent build state used to detect stale outputs.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import threading
+
+from .fscache import stat_cache
+from .util import *
+
+#--------------------------------------------------------------------
+DATABASE_DIR = '.bakery'
+DATABASE_NAME = 'db'
+DATABASE_VERSION = 1
+
+#--------------------------------------------------------------------
+def file_digest(filename):
+    """
+        Returns the SHA-1 hex digest of the contents of the given file.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+#--------------------------------------------------------------------
+def file_stamp(filename):
+    """
+        Returns the (mtime_ns, size) of the given file, or None if
+        the file does not exist.
+    """
+    st = stat_cache.stat(filename)
+    if st is None:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+#--------------------------------------------------------------------
+class BuildDatabase:
+    """
+        Records, for each FileTask output, the fingerprints of the
+        declared and discovered inputs and the signature (e.g. the
+        compiler and flags) that it was last built from.  An output is
+        considered current only if all of these are unchanged, and
+        any inputs which are themselves recorded outputs are current.
+        An input which no longer exists, such as a cleaned up temporary
+        object file, counts as unchanged if its own recorded inputs
+        are unchanged.
+
+        Input fingerprints are (mtime_ns, size, sha1).  When only the
+        mtime of an input has changed, its contents are hashed and
+        compared so that touching a file does not cause a rebuild.
+
+        Tasks that are found not to be current are held as pending
+        along with the stamp of their output before they are run.
+        When the database is committed at the end of the build, each
+        pending task is recorded if it completed in this process or
+        if its output has since been rewritten, which covers tasks
+        run in worker processes.
+    """
+    _instance = None
+
+    @staticmethod
+    def get():
+        if BuildDatabase._instance is None:
+            BuildDatabase._instance = BuildDatabase(os.path.join(DATABASE_DIR, DATABASE_NAME))
+        return BuildDatabase._instance
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.lock = threading.RLock()
+        self.records = None
+        self.pending = {}
+        self.completed = set()
+        self.dirty = False
+        os.register_at_fork(after_in_child = self._after_fork)
+
+    def _after_fork(self):
+        # Another thread may have held the lock when the process forked.
+        self.lock = threading.RLock()
+
+    def _load(self):
+        if self.records is not None:
+            return self.records
+        self.records = {}
+        try:
+            with open(self.filename, 'r') as infile:
+                data = json.load(infile)
+            if data.get('version') == DATABASE_VERSION:
+                self.records = data.get('records', {})
+        except (OSError, ValueError):
+            pass
+        return self.records
+
+    def save(self):
+        """
+            Write the database to disk if it has changed.  The database
+            is written to a temporary file and renamed into place so
+            that an interrupted build never leaves it truncated.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.filename), exist_ok = True)
+            tmp_filename = '%s.%d.tmp' % (self.filename, os.getpid())
+            with open(tmp_filename, 'w') as outfile:
+                json.dump({'version': DATABASE_VERSION, 'records': self.records}, outfile)
+            os.replace(tmp_filename, self.filename)
+            self.dirty = False
+
+    def signature_for(self, task):
+        signature = task.signature()
+        if signature is None:
+            return None
+        return [str(x) for x in flat_map(signature)]
+
+    def _fingerprint_matches(self, filename, fingerprint, seen):
+        stamp = file_stamp(filename)
+        if stamp is None:
+            # A missing input may be an intermediate output that has
+            # since been cleaned up, in which case it is as good as
+            # unchanged if it would be rebuilt from unchanged inputs.
+            return self._is_recorded_current(filename, seen)
+        if stamp != fingerprint[:2]:
+            if stamp[1] != fingerprint[1] or file_digest(filename) != fingerprint[2]:
+                return False
+            # Contents are unchanged, remember the new mtime to avoid rehashing.
+            fingerprint[0] = stamp[0]
+            self.dirty = True
+        # An input which is itself an output, e.g. an object file, is
+        # about to be rebuilt if its own inputs have changed.
+        if filename in self._load():
+            return self._is_recorded_current(filename, seen)
+        return True
+
+    def _is_recorded_current(self, filename, seen):
+        if filename in seen:
+            return seen[filename]
+        record = self._load().get(filename)
+        seen[filename] = False
+        if record is None:
+            return False
+        fingerprints = [*record['inputs'].items(), *record.get('discovered', {}).items()]
+        seen[filename] = all(self._fingerprint_matches(input_filename, fingerprint, seen)
+                             for input_filename, fingerprint in fingerprints)
+        return seen[filename]
+
+    def is_current(self, task):
+        """
+            Determine if the given FileTask was last built from the
+            same signature and unchanged inputs.  Does not check that
+            the output itself exists.
+        """
+        with self.lock:
+            filename = task.file.abspath()
+            record = self._load().get(filename)
+            if record is None:
+                return False
+            if record['signature'] != self.signature_for(task):
+                return False
+            if set(record['inputs'].keys()) != {f.abspath() for f in task.inputs()}:
+                return False
+            return self._is_recorded_current(filename, {})
+
+    def changed_inputs(self, task):
+        """
+            Returns the inputs of the given FileTask which have changed
+            or been added since it was last built, so that its output
+            may be updated rather than rebuilt.  Returns None if there
+            is no record of it, or it was built from a different
+            signature or from inputs which have since been removed.
+        """
+        with self.lock:
+            record = self._load().get(task.file.abspath())
+            if record is None or record['signature'] != self.signature_for(task):
+                return None
+            inputs = task.inputs()
+            if not set(record['inputs'].keys()) <= {f.abspath() for f in inputs}:
+                return None
+            changed = []
+            for f in inputs:
+                fingerprint = record['inputs'].get(f.abspath())
+                stamp = file_stamp(f.abspath())
+                if fingerprint is None or stamp is None or (
+                        stamp != fingerprint[:2] and file_digest(f.abspath()) != fingerprint[2]):
+                    changed.append(f)
+            return changed
+
+    def expect(self, task):
+        """
+            Mark the given FileTask as expected to be run in this build,
+            remembering the stamp of its output before it is run.
+        """
+        with self.lock:
+            filename = task.file.abspath()
+            if filename not in self.pending:
+                self.pending[filename] = (task, file_stamp(filename))
+
+    def complete(self, task):
+        """
+            Mark the given FileTask as having been run successfully.
+        """
+        with self.lock:
+            self.completed.add(task.file.abspath())
+
+    def _fingerprints(self, files, exclude = ()):
+        fingerprints = {}
+        for f in files:
+            filename = f.abspath()
+            if filename in exclude:
+                continue
+            stamp = file_stamp(filename)
+            if stamp is not None:
+                fingerprints[filename] = stamp + [file_digest(filename)]
+        return fingerprints
+
+    def record(self, task):
+        """
+            Record the current signature and input fingerprints for
+            the given FileTask, along with any inputs it discovered
+            while being run, e.g. headers listed in a depfile.
+        """
+        with self.lock:
+            inputs = self._fingerprints(task.inputs())
+            self._load()[task.file.abspath()] = {
+                'signature': self.signature_for(task),
+                'inputs': inputs,
+                'discovered': self._fingerprints(task.discovered_inputs(), exclude = inputs)
+            }
+            self.dirty = True
+
+    def forget(self, task):
+        """
+            Remove any record of the given FileTask, e.g. after it
+            has failed and its output can no longer be trusted.
+        """
+        with self.lock:
+            filename = task.file.abspath()
+            if self._load().pop(filename, None) is not None:
+                self.dirty = True
+            self.pending.pop(filename, None)
+            self.completed.discard(filename)
+
+    def commit(self):
+        """
+            Record every pending task which has been run since it was
+            found to be out of date, then save the database.
+        """
+        with self.lock:
+            # Outputs may have been written by worker processes.
+            stat_cache.clear()
+            for filename, (task, stamp) in self.pending.items():
+                new_stamp = file_stamp(filename)
+                if new_stamp is None:
+                    continue
+                if filename in self.completed or new_stamp != stamp:
+                    self.record(task)
+            self.pending.clear()
+            self.completed.clear()
+            self.save()
@@ -0,0 +1,149 @@
+#--------------------------------------------------------------------
+# bakery.engine: An asyncio based engine for running subprocesses.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import asyncio
+import collections
+import os
+import signal
+import threading
+
+#--------------------------------------------------------------------
+ShellResult = collections.namedtuple('ShellResult', ['returncode', 'stdout', 'stderr'])
+
+#--------------------------------------------------------------------
+class ShellEngine:
+    """
+        Runs subprocesses from a single asyncio event loop on a
+        background thread, with at most 'limit' of them running at
+        once.  Any number of threads may submit commands via 'run()',
+        which blocks the calling thread only, so many tasks can wait
+        on their compilers without each holding a process of its own.
+
+        The standard output and error of each command are captured
+        and returned in a ShellResult.
+
+        The engine is restarted transparently in forked children, as
+        the event loop thread does not survive a fork.
+    """
+    def __init__(self, limit = None):
+        self.limit = limit or os.cpu_count() or 1
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.semaphore = None
+        self.pid = None
+        self.processes = {}
+        self.cancelled = set()
+        os.register_at_fork(after_in_child = self._after_fork)
+
+    def _after_fork(self):
+        # Another thread may have held the lock when the process forked,
+        # and the parent's subprocesses are not this process's to kill.
+        self.lock = threading.Lock()
+        self.processes = {}
+        self.cancelled = set()
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.loop is not None and self.pid == os.getpid():
+                return self.loop
+            self.pid = os.getpid()
+            self.loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run_loop():
+                asyncio.set_event_loop(self.loop)
+                self.semaphore = asyncio.Semaphore(self.limit)
+                started.set()
+                self.loop.run_forever()
+
+            self.thread = threading.Thread(target = run_loop, name = 'bakery-shell-engine', daemon = True)
+            self.thread.start()
+            started.wait()
+            return self.loop
+
+    async def execute(self, argv, cwd = None, env = None, pass_fds = (), owner = None):
+        """
+            Run the given command line, returning a ShellResult.  Must
+            be awaited on the engine's event loop, see 'submit()'.
+            'owner' identifies the thread the command was run for, see
+            'terminate()'.
+        """
+        async with self.semaphore:
+            if owner in self.cancelled:
+                return ShellResult(-signal.SIGTERM, b'', b'')
+            proc = await asyncio.create_subprocess_exec(*argv, cwd = cwd, env = env, pass_fds = pass_fds,
+                stdout = asyncio.subprocess.PIPE, stderr = asyncio.subprocess.PIPE)
+            self.processes[proc.pid] = owner
+            try:
+                stdout, stderr = await proc.communicate()
+            finally:
+                del self.processes[proc.pid]
+            return ShellResult(proc.returncode, stdout, stderr)
+
+    def submit(self, argv, cwd = None, env = None, pass_fds = ()):
+        """
+            Schedule the given command line on the engine, returning a
+            concurrent.futures.Future for its ShellResult.
+        """
+        loop = self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self.execute(argv, cwd = cwd, env = env,
+            pass_fds = pass_fds, owner = threading.get_ident()), loop)
+
+    def run(self, argv, cwd = None, env = None, pass_fds = ()):
+        """
+            Run the given command line on the engine, blocking the
+            calling thread until it completes.
+        """
+        return self.submit(argv, cwd = cwd, env = env, pass_fds = pass_fds).result()
+
+    def terminate(self, owners = None):
+        """
+            Send SIGTERM to the running subprocesses which were run for
+            the given thread idents, or to all of them if 'owners' is
+            None.  Further commands from these threads fail immediately
+            until 'resume()' is called for them.  Safe to call from a
+            signal handler.
+        """
+        if owners is not None:
+            self.cancelled.update(owners)
+        for pid, owner in list(self.processes.items()):
+            if owners is None or owner in owners:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def resume(self, owners):
+        self.cancelled.difference_update(owners)
+
+    def shutdown(self):
+        with self.lock:
+            if self.loop is not None and self.pid == os.getpid():
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join()
+                self.loop.close()
+            self.loop = None
+            self.thread = None
+
+#--------------------------------------------------------------------
+_engine = ShellEngine()
+
+#--------------------------------------------------------------------
+def get_engine():
+    return _engine
+
+#--------------------------------------------------------------------
+def set_engine_limit(limit):
+    """
+        Set the maximum number of subprocesses the engine runs at
+        once.  Takes effect when the engine is next started.
+    """
+    global _engine
+    if limit != _engine.limit:
+        _engine.shutdown()
+        _engine = ShellEngine(limit)
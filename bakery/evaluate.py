@@ -6,60 +6,196 @@
 #--------------------------------------------------------------------
 
 import collections
+import concurrent.futures
+import threading
 
 from .work import *
 from .error import *
 from .log import *
+from .trace import trace_span
 
 #--------------------------------------------------------------------
 class EvaluationError(BuildError):
     pass
 
+#--------------------------------------------------------------------
+def dependents_first(dep_graph):
+    """
+        Returns the targets in the given dependency graph ordered such
+        that every target appears before all of its dependencies.
+    """
+    counts = {target: 0 for target in dep_graph}
+    for deps in dep_graph.values():
+        for dep in set(deps):
+            counts[dep] = counts.get(dep, 0) + 1
+
+    order = []
+    todo = collections.deque(target for target, count in counts.items() if count == 0)
+    while todo:
+        target = todo.popleft()
+        order.append(target)
+        for dep in set(dep_graph.get(target, ())):
+            counts[dep] -= 1
+            if counts[dep] == 0:
+                todo.append(dep)
+
+    if len(order) != len(counts):
+        raise EvaluationError('Dependency cycle detected among: %s' % repr(set(counts) - set(order)))
+    return order
+
 #--------------------------------------------------------------------
 class EvaluationDecider:
-    def get_evaluation_set(self, injector, target, higher_eval_set = None):
+    def __init__(self):
+        # Guards access to the injector when targets are evaluated
+        # concurrently by the TaskEvaluator.
+        self.lock = threading.RLock()
+
+    def get_evaluation_set(self, injector, targets, dep_graph, order = None):
         raise NotImplementedError()
 
     def evaluate(self, injector, target):
         raise NotImplementedError()
 
+#--------------------------------------------------------------------
+class EvaluationSchedule:
+    """
+        Tracks the number of outstanding dependencies for each target
+        in a dependency graph, allowing targets to be dispatched as
+        soon as the last of their dependencies has completed rather
+        than in fixed levels.
+
+        Targets in the graph which are not part of the evaluation set
+        are passed through without being evaluated, but they still
+        hold back their dependents until their own dependencies have
+        completed.
+    """
+    def __init__(self, dep_graph, eval_set):
+        self.eval_set = set(eval_set)
+        self.remaining = set(self.eval_set)
+        self.pending = {}
+        self.dependents = collections.defaultdict(list)
+
+        for target, deps in dep_graph.items():
+            deps = set(deps)
+            self.pending[target] = len(deps)
+            for dep in deps:
+                self.dependents[dep].append(target)
+
+    def start(self):
+        """
+            Returns the list of targets which are ready to be evaluated
+            before anything else has completed.
+        """
+        return self._release([target for target, count in self.pending.items() if count == 0])
+
+    def complete(self, target):
+        """
+            Marks the given target as completed, returning the list of
+            targets which have become ready to be evaluated as a result.
+        """
+        self.remaining.discard(target)
+        return self._release(self._resolve(target))
+
+    def is_finished(self):
+        return not self.remaining
+
+    def _resolve(self, target):
+        resolved = []
+        for dependent in self.dependents.get(target, ()):
+            self.pending[dependent] -= 1
+            if self.pending[dependent] == 0:
+                resolved.append(dependent)
+        return resolved
+
+    def _release(self, targets):
+        ready = []
+        todo = collections.deque(targets)
+        while todo:
+            target = todo.popleft()
+            if target in self.eval_set:
+                ready.append(target)
+            else:
+                todo.extend(self._resolve(target))
+        return ready
+
 #--------------------------------------------------------------------
 class TaskEvaluator:
-    def __init__(self, decider):
+    def __init__(self, decider, jobs = 1, graph_cache = None):
         self.decider = decider
+        self.jobs = max(1, jobs or 1)
+        self.graph_cache = graph_cache
+        self.dep_graph = None
+        self.eval_set = None
+
+    def get_dependency_graph(self, injector, targets):
+        """
+            Returns the dependency graph for the given targets and its
+            dependents-first order, from the graph cache if possible.
+        """
+        with trace_span('resolve graph', 'build'):
+            cached = self.graph_cache.load() if self.graph_cache else None
+            if cached is not None:
+                return cached
+            dep_graph = injector.get_dependency_graph(*targets)
+            order = dependents_first(dep_graph)
+            if self.graph_cache:
+                self.graph_cache.store(dep_graph, order)
+            return dep_graph, order
 
     def evaluate(self, injector, targets):
-        eval_set = set()
-        dep_graph = injector.get_dependency_graph(*targets)
-        for target in targets:
-            eval_set |= self.decider.get_evaluation_set(injector, target)
-
-        eval_deck = self._calculate_eval_deck(dep_graph, eval_set)
-        
-        for card_set in eval_deck:
-            self._evaluate_card(injector, card_set)
-    
-    def _evaluate_card(self, injector, card_set):
-        for target in card_set:
+        dep_graph, order = self.get_dependency_graph(injector, targets)
+        self.dep_graph = dep_graph
+        with trace_span('evaluation set', 'build'):
+            eval_set = self.decider.get_evaluation_set(injector, targets, dep_graph, order)
+        self.eval_set = eval_set
+
+        schedule = EvaluationSchedule(dep_graph, eval_set)
+        if self.jobs > 1:
+            self._evaluate_concurrently(injector, schedule)
+        else:
+            self._evaluate_serially(injector, schedule)
+
+        if not schedule.is_finished():
+            # This should never happen because of the dependency cycle checks in xeno, but just in case...
+            raise EvaluationError('Unable to resolve remaining dependencies for build: %s' % repr(schedule.remaining))
+
+    def _evaluate_serially(self, injector, schedule):
+        ready = collections.deque(schedule.start())
+        while ready:
+            target = ready.popleft()
             self.decider.evaluate(injector, target)
+            ready.extend(schedule.complete(target))
+
+    def _evaluate_concurrently(self, injector, schedule):
+        """
+            Evaluate ready targets on a pool of up to 'jobs' worker
+            threads.  Once a target fails, no new targets are dispatched,
+            and the failures of all targets still in flight are reported
+            in the order they were dispatched once they have finished.
+        """
+        ready = collections.deque(schedule.start())
+        running = {}
+        failures = []
+        dispatch_count = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.jobs) as executor:
+            while running or (ready and not failures):
+                while ready and not failures:
+                    target = ready.popleft()
+                    future = executor.submit(self.decider.evaluate, injector, target)
+                    running[future] = (dispatch_count, target)
+                    dispatch_count += 1
 
-    def _calculate_eval_deck(self, dep_graph, eval_set):
-        processed_set = set()
-        eval_deck = []
-        todo_set = set(eval_set)
-
-        while todo_set:
-            card_set = set()
-            for target in todo_set:
-                todo_deps = {x for x in dep_graph[target] if x in eval_set}
-                if all(x in processed_set for x in todo_deps):
-                    card_set.add(target)
-            if not card_set:
-                # This should never happen because of the dependency cycle checks in xeno, but just in case...
-                raise EvaluationError('Unable to resolve remaining dependencies for build deck: %s' % repr(todo_set))
-            eval_deck.append(card_set)
-            processed_set |= card_set
-            todo_set ^= card_set
-        
-        return eval_deck
+                done, _ = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    index, target = running.pop(future)
+                    if future.exception() is not None:
+                        failures.append((index, target, future.exception()))
+                    else:
+                        ready.extend(schedule.complete(target))
 
+        if failures:
+            failures.sort(key = lambda failure: failure[0])
+            for index, target, e in failures[1:]:
+                BuildLog.get(self).error('Target \'%s\' also failed: %s' % (target, str(e)))
+            raise failures[0][2]
@@ -0,0 +1,142 @@
+#--------------------------------------------------------------------
+# bakery.fastpath: Detecting no-op builds without loading the build.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+# This module is used by 'bake' before anything else is imported,
+# so it must only depend on the standard library.
+
+import hashlib
+import json
+import os
+import sys
+
+#--------------------------------------------------------------------
+MANIFEST_DIR = '.bakery'
+MANIFEST_NAME = 'noop'
+MANIFEST_VERSION = 1
+
+# Modules whose code affects the outcome of a build, besides the
+# build modules themselves.
+WATCHED_MODULE_PREFIXES = ('bakery', 'xeno')
+
+#--------------------------------------------------------------------
+def manifest_key(bakefile_digest, argv):
+    """
+        Identifies a 'bake' invocation: the Bakefile, the command line,
+        the working directory, Bakery's environment variables and the
+        Python version.
+    """
+    return hashlib.sha256(json.dumps({
+        'version': MANIFEST_VERSION,
+        'bakefile': bakefile_digest,
+        'argv': list(argv),
+        'cwd': os.getcwd(),
+        'env': sorted((k, v) for k, v in os.environ.items() if k.startswith('BAKERY_')),
+        'python': sys.version
+    }).encode('utf-8')).hexdigest()
+
+#--------------------------------------------------------------------
+def stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+#--------------------------------------------------------------------
+def is_up_to_date(bakefile_digest, argv):
+    """
+        Determine from the manifest written by the last no-op build
+        whether this invocation would also be a no-op, i.e. whether
+        every file it watched still has the same stamp.
+    """
+    try:
+        with open(os.path.join(MANIFEST_DIR, MANIFEST_NAME), 'r') as infile:
+            manifest = json.load(infile)
+    except (OSError, ValueError):
+        return False
+    if manifest.get('key') != manifest_key(bakefile_digest, argv):
+        return False
+    return all(stamp(path) == expected for path, expected in manifest['files'])
+
+#--------------------------------------------------------------------
+def remove_manifest():
+    try:
+        os.remove(os.path.join(MANIFEST_DIR, MANIFEST_NAME))
+    except OSError:
+        pass
+
+#--------------------------------------------------------------------
+class NoopManifest:
+    """
+        Collects the files a build depends on while it runs.  When
+        every build in a 'bake' invocation was a no-op and consisted
+        only of FileTasks, their outputs, inputs, discovered inputs
+        and the directories holding the inputs (to notice files added
+        to a globbed directory) are written out with their stamps,
+        along with the sources of the modules involved.
+
+        Only no-op builds are recorded, so that the stamps written are
+        those of files which were just found to be current.
+    """
+    def __init__(self):
+        self.tasks = []
+        self.modules = []
+        self.valid = True
+
+    def invalidate(self):
+        self.valid = False
+
+    def add_build(self, actionables, modules):
+        """
+            Add the actionables of a no-op build, or invalidate the
+            manifest if any of them is not a FileTask or a queue of
+            FileTasks, as these can't be checked without running them.
+        """
+        from .file import FileTask
+        from .work import TaskQueue
+
+        todo = list(actionables)
+        while todo and self.valid:
+            task = todo.pop()
+            if isinstance(task, TaskQueue):
+                todo.extend(task.queue)
+            elif isinstance(task, FileTask):
+                self.tasks.append(task)
+            else:
+                self.invalidate()
+        self.modules.extend(modules)
+
+    def watched_files(self):
+        module_names = {module.__module__ for module in self.modules}
+        files = set()
+        for name, module in list(sys.modules.items()):
+            filename = getattr(module, '__file__', None)
+            if filename and (name in module_names or any(
+                    name == prefix or name.startswith(prefix + '.') for prefix in WATCHED_MODULE_PREFIXES)):
+                files.add(os.path.abspath(filename))
+        for task in self.tasks:
+            inputs = [*task.inputs(), *task.discovered_inputs()]
+            for f in [task.file, *task.outputs(), *inputs]:
+                files.add(f.abspath())
+            for f in inputs:
+                files.add(os.path.dirname(f.abspath()))
+        return sorted(files)
+
+    def save(self, bakefile_digest, argv):
+        if not self.valid or not self.tasks:
+            remove_manifest()
+            return
+        manifest = {
+            'key': manifest_key(bakefile_digest, argv),
+            'files': [[path, stamp(path)] for path in self.watched_files()]
+        }
+        os.makedirs(MANIFEST_DIR, exist_ok = True)
+        filename = os.path.join(MANIFEST_DIR, MANIFEST_NAME)
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'w') as outfile:
+            json.dump(manifest, outfile)
+        os.replace(tmp_filename, filename)
@@ -6,14 +6,19 @@
 # Date: Thursday, March 23 2017
 #--------------------------------------------------------------------
 
+import contextlib
 import functools
 import glob
 import logging
 import os
 import shutil
 
-from .work import Task, Cleanable, Interpolatable, CleanupError
+from .work import Task, TaskQueue, Cleanable, Interpolatable, CleanupError, BatchError
 from .log import BuildLog
+from .db import BuildDatabase, file_digest
+from .cache import cache_key
+from .fscache import stat_cache
+from .util import wide_foreach, name_for_class
 
 #--------------------------------------------------------------------
 class File(Cleanable, Interpolatable):
@@ -58,31 +63,46 @@ class File(Cleanable, Interpolatable):
             Returns the absolute path of the File as a string, as per
             'os.path.abspath()'.
         """
-        return os.path.abspath(os.path.expanduser(self.filename))
+        return stat_cache.abspath(self.filename)
 
     def remove(self):
         """
             Removes the file if it exists, otherwise does nothing.
         """
         if self.exists():
-            if os.path.isdir(self.abspath()):
+            if self.is_dir():
                 BuildLog.get(self).task('Deleting directory: %s' % self.relpath())
                 shutil.rmtree(self.abspath())
             else:
                 BuildLog.get(self).task('Deleting file: %s' % self.relpath())
                 os.remove(self.abspath())
+            self.invalidate()
 
     def exists(self):
         """
             Determine if the File exists on disk as per 'os.path.exists()'.
         """
-        return os.path.exists(self.abspath())
+        return stat_cache.exists(self.abspath())
 
     def is_dir(self):
         """
             Determine if this File object refers to a directory.
         """
-        return os.path.isdir(self.abspath())
+        return stat_cache.is_dir(self.abspath())
+
+    def stat(self):
+        """
+            Returns the 'os.stat()' result for this File, or None if
+            it does not exist.
+        """
+        return stat_cache.stat(self.abspath())
+
+    def invalidate(self):
+        """
+            Discard any cached stat result for this File, e.g. after
+            it has been written.
+        """
+        stat_cache.invalidate(self.abspath())
 
     def relpath(self, path = None):
         """
@@ -90,7 +110,7 @@ class File(Cleanable, Interpolatable):
             the current directory as per 'os.path.relpath()'.
         """
         if path is None:
-            path = os.getcwd()
+            path = stat_cache.getcwd()
         return os.path.relpath(self.abspath(), path)
     
     def needs_cleaning(self, recursive = False):
@@ -105,17 +125,140 @@ class File(Cleanable, Interpolatable):
     def interp(self):
         return [self.abspath()]
 
+#--------------------------------------------------------------------
+def collect_files(obj):
+    """
+        Collects the File objects referred to by the given structure
+        of Files, file names, FileTasks and TaskQueues.  FileTasks
+        contribute the file they will produce, so this can be used
+        before any of the tasks have been run.
+    """
+    files = []
+    def collect(x):
+        if isinstance(x, FileTask):
+            files.append(x.file)
+        elif isinstance(x, File):
+            files.append(x)
+        elif isinstance(x, TaskQueue):
+            wide_foreach(x.breakdown(), collect)
+        elif isinstance(x, str):
+            files.append(File(x))
+    wide_foreach(obj, collect)
+    return files
+
+#--------------------------------------------------------------------
+def parse_depfile(filename):
+    """
+        Parses a Makefile style depfile, as written by compilers via
+        '-MD' or '-MMD', returning a list of File objects for the
+        prerequisites of its rules.  Returns an empty list if the
+        depfile does not exist.
+    """
+    try:
+        with open(filename, 'r') as infile:
+            text = infile.read()
+    except OSError:
+        return []
+
+    files = []
+    for rule in text.replace('\\\n', ' ').splitlines():
+        target, sep, prereqs = rule.partition(': ')
+        if not sep:
+            continue
+        token = ''
+        escaped = False
+        for c in prereqs + ' ':
+            if escaped:
+                token += c
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c.isspace():
+                if token:
+                    files.append(File(token.replace('$$', '$')))
+                token = ''
+            else:
+                token += c
+    return files
+
 #--------------------------------------------------------------------
 class FileTask(Task, Cleanable, Interpolatable):
     """
         Base class for a task that generates a file on disk.
+
+        A FileTask is done when its file exists and the BuildDatabase
+        shows that it was last built from the same inputs and
+        signature.  Subclasses should override 'inputs()' and
+        'signature()' to describe what their file is built from.
     """
+    # An optional bakery.cache.Cache shared by all FileTasks, see
+    # the '--shared-cache' option.
+    cache = None
+
     def __init__(self, file):
         super().__init__(str(file))
         self.file = file
 
+    def inputs(self):
+        """
+            Returns the list of File objects this task's file is built from.
+        """
+        return []
+
+    def signature(self):
+        """
+            Returns a list of values, e.g. a compiler and its flags,
+            which should cause the file to be rebuilt when changed.
+        """
+        return None
+
+    def discovered_inputs(self):
+        """
+            Returns the list of File objects this task's file was found
+            to depend on after it was last run, e.g. the headers listed
+            in a compiler generated depfile.  These are recorded in the
+            BuildDatabase and checked alongside 'inputs()'.
+        """
+        return []
+
+    def outputs(self):
+        """
+            Returns the list of all File objects produced by this task.
+        """
+        return [self.file]
+
+    def cached_outputs(self):
+        """
+            Returns the list of File objects which are stored and
+            restored together when caching, by default all 'outputs()'.
+            Outputs which depend on where the task is run, such as a
+            depfile listing absolute paths, should be left out and
+            produced locally by 'cache_key()' instead.
+        """
+        return self.outputs()
+
+    def cache_key(self):
+        """
+            Returns a key identifying this task's outputs by its
+            signature and the contents of its inputs for use with a
+            bakery.cache.Cache, or None if the task can't be cached.
+        """
+        signature = BuildDatabase.get().signature_for(self)
+        if signature is None:
+            return None
+        inputs = []
+        for f in self.inputs():
+            if not f.exists():
+                return None
+            inputs.append((f.relpath(), file_digest(f.abspath())))
+        return cache_key(name_for_class(self), signature, sorted(inputs))
+
     def is_done(self):
-        return self.file.exists()
+        db = BuildDatabase.get()
+        if self.file.exists() and db.is_current(self):
+            return True
+        db.expect(self)
+        return False
 
     def needs_cleaning(self, recursive = False):
         return self.file.needs_cleaning(recursive = recursive)
@@ -125,7 +268,57 @@ class FileTask(Task, Cleanable, Interpolatable):
 
     def clean(self):
         self.file.clean()
-    
+
     def interp(self):
         return self.file.interp()
 
+    def invalidate(self):
+        self.file.invalidate()
+
+    @staticmethod
+    def build_together(tasks, command):
+        """
+            Runs 'command()', which builds the outputs of all the given
+            tasks at once, e.g. as a 'run_batch()' implementation.  Any
+            previous outputs are removed first, so that each task whose
+            file exists afterwards was built by the command and can be
+            recorded as complete.  Raises BatchError naming the tasks
+            whose files were not built.
+        """
+        for task in tasks:
+            for f in task.outputs():
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(f.abspath())
+                f.invalidate()
+        try:
+            command()
+        finally:
+            failed = []
+            for task in tasks:
+                task.invalidate()
+                if task.file.exists():
+                    BuildDatabase.get().complete(task)
+                else:
+                    BuildDatabase.get().forget(task)
+                    failed.append(task)
+        if failed:
+            raise BatchError('Failed to build: %s' % ', '.join(task.file.relpath() for task in failed))
+        return [task.result() for task in tasks]
+
+    def __call__(self):
+        try:
+            key = self.cache_key() if FileTask.cache is not None else None
+            if key is None:
+                result = self.run()
+            elif FileTask.cache.run(key, self.cached_outputs(), self.run):
+                BuildLog.get(self).task('Restored from cache: %s' % self.file.relpath())
+                result = self.result()
+            else:
+                result = self.result()
+        except Exception:
+            BuildDatabase.get().forget(self)
+            raise
+        finally:
+            self.invalidate()
+        BuildDatabase.get().complete(self)
+        return result
@@ -0,0 +1,74 @@
+#--------------------------------------------------------------------
+# bakery.fscache: A per-build cache of file system lookups.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import os
+import stat
+
+#--------------------------------------------------------------------
+class StatCache:
+    """
+        Caches normalized absolute paths and 'os.stat()' results so
+        that each path is normalized and stat'ed at most once per
+        build, no matter how many times it is checked by 'is_done()',
+        'needs_cleaning()', logging and so on.
+
+        The cache assumes that the working directory does not change
+        during a build.  Entries must be invalidated whenever a file
+        is written or removed, which FileTask and File do for the
+        files they produce and remove.  The cache is cleared at the
+        start of each build.
+    """
+    def __init__(self):
+        self.abspaths = {}
+        self.stats = {}
+        self.cwd = None
+
+    def clear(self):
+        self.abspaths.clear()
+        self.stats.clear()
+        self.cwd = None
+
+    def getcwd(self):
+        if self.cwd is None:
+            self.cwd = os.getcwd()
+        return self.cwd
+
+    def abspath(self, filename):
+        try:
+            return self.abspaths[filename]
+        except KeyError:
+            path = os.path.abspath(os.path.expanduser(filename))
+            self.abspaths[filename] = path
+            return path
+
+    def stat(self, path):
+        """
+            Returns the 'os.stat()' result for the given absolute path,
+            or None if it does not exist.
+        """
+        try:
+            return self.stats[path]
+        except KeyError:
+            try:
+                result = os.stat(path)
+            except OSError:
+                result = None
+            self.stats[path] = result
+            return result
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def is_dir(self, path):
+        result = self.stat(path)
+        return result is not None and stat.S_ISDIR(result.st_mode)
+
+    def invalidate(self, path):
+        self.stats.pop(path, None)
+
+#--------------------------------------------------------------------
+stat_cache = StatCache()
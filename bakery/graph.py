@@ -0,0 +1,108 @@
+#--------------------------------------------------------------------
+# bakery.graph: Caching of resolved dependency graphs across builds.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import sys
+
+from .db import DATABASE_DIR, file_digest
+
+#--------------------------------------------------------------------
+GRAPH_CACHE_NAME = 'graph'
+GRAPH_CACHE_VERSION = 1
+
+# Modules whose code determines the shape of the dependency graph,
+# besides the Bakefile and the build modules themselves.
+GRAPH_MODULE_PREFIXES = ('bakery', 'xeno')
+
+#--------------------------------------------------------------------
+_module_digests = {}
+
+#--------------------------------------------------------------------
+def module_digest(filename):
+    """
+        Returns the digest of the given module source file, computed
+        at most once per process as modules don't change once loaded.
+    """
+    if filename not in _module_digests:
+        try:
+            _module_digests[filename] = file_digest(filename)
+        except OSError:
+            _module_digests[filename] = None
+    return _module_digests[filename]
+
+#--------------------------------------------------------------------
+def _is_graph_module(name, module_names):
+    return (name in module_names or
+            any(name == prefix or name.startswith(prefix + '.') for prefix in GRAPH_MODULE_PREFIXES))
+
+#--------------------------------------------------------------------
+class GraphCache:
+    """
+        Stores the dependency graph and dependents-first order for a
+        set of targets in '.bakery/graph', so that builds from an
+        unchanged Bakefile can skip resolving the graph through the
+        injector.  Only the most recent graph is kept.
+
+        The cache is keyed by the digest of the Bakefile, the digests
+        of the loaded Bakery, xeno and build module sources, and the
+        targets being built.  A Bakefile whose targets depend on
+        anything else, e.g. environment variables, should be built
+        with '--no-graph-cache'.
+    """
+    def __init__(self, filename, key):
+        self.filename = os.path.abspath(filename)
+        self.key = key
+
+    @staticmethod
+    def for_build(bakefile_digest, modules, targets):
+        """
+            Returns the GraphCache for building the given targets from
+            the given build module classes, or None if the Bakefile's
+            digest is unknown, e.g. when not run by 'bake'.
+        """
+        if bakefile_digest is None:
+            return None
+        module_names = {module.__module__ for module in modules}
+        sources = []
+        for name, module in sorted(sys.modules.items()):
+            filename = getattr(module, '__file__', None)
+            if filename and _is_graph_module(name, module_names):
+                sources.append([name, module_digest(filename)])
+        key = hashlib.sha256(json.dumps({
+            'version': GRAPH_CACHE_VERSION,
+            'bakefile': bakefile_digest,
+            'modules': sources,
+            'targets': list(targets)
+        }).encode('utf-8')).hexdigest()
+        return GraphCache(os.path.join(DATABASE_DIR, GRAPH_CACHE_NAME), key)
+
+    def load(self):
+        """
+            Returns the cached (dep_graph, order), or None if there is
+            no graph cached for this key.
+        """
+        try:
+            with open(self.filename, 'r') as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            return None
+        if data.get('key') != self.key:
+            return None
+        return data['graph'], data['order']
+
+    def store(self, dep_graph, order):
+        os.makedirs(os.path.dirname(self.filename), exist_ok = True)
+        tmp_filename = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp_filename, 'w') as outfile:
+            json.dump({
+                'key': self.key,
+                'graph': {target: list(deps) for target, deps in dep_graph.items()},
+                'order': order
+            }, outfile)
+        os.replace(tmp_filename, self.filename)
@@ -0,0 +1,239 @@
+#--------------------------------------------------------------------
+# bakery.jobserver: GNU make jobserver client and server support.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import atexit
+import contextlib
+import os
+import select
+import stat
+import threading
+
+from .log import BuildLog
+
+#--------------------------------------------------------------------
+IMPLICIT_TOKEN = None
+TOKEN = b'+'
+JOBSERVER_FLAGS = ('--jobserver-auth=', '--jobserver-fds=')
+
+#--------------------------------------------------------------------
+class Jobserver:
+    """
+        A pool of job tokens shared with GNU make via the jobserver
+        protocol, either inherited from a parent make through the
+        '--jobserver-auth' setting in MAKEFLAGS, or created by Bakery
+        for its own child processes.
+
+        Every process holds one implicit token, so the first job
+        slot is always available without reading from the jobserver.
+        The implicit token belongs only to the process which set up
+        the jobserver, forked pool workers always read real tokens.
+    """
+    def __init__(self, read_fd, write_fd, makeflags = None, fifo = None):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.makeflags = makeflags
+        self.fifo = fifo
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.implicit_free = True
+        self.held = 0
+        os.register_at_fork(after_in_child = self._after_fork)
+
+    def _after_fork(self):
+        # Another thread may have held the lock when the process forked.
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_makeflags(makeflags):
+        """
+            Connect to the jobserver described by the given MAKEFLAGS,
+            supporting both the 'fifo:PATH' and 'R,W' forms.  Returns
+            None if there is no usable jobserver, e.g. if the parent
+            make did not pass its file descriptors to this process.
+        """
+        auth = None
+        for arg in (makeflags or '').split():
+            for flag in JOBSERVER_FLAGS:
+                if arg.startswith(flag):
+                    auth = arg[len(flag):]
+        if auth is None:
+            return None
+
+        log = BuildLog.get(Jobserver)
+        if auth.startswith('fifo:'):
+            try:
+                fd = os.open(auth[len('fifo:'):], os.O_RDWR)
+            except OSError as e:
+                log.warning('Unable to open jobserver fifo "%s": %s' % (auth, str(e)))
+                return None
+            return Jobserver(fd, fd)
+
+        try:
+            read_fd, write_fd = (int(fd) for fd in auth.split(','))
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+        except (ValueError, OSError):
+            log.warning('Jobserver "%s" is unavailable, prefix the make recipe with "+" to share it.' % auth)
+            return None
+        return Jobserver(read_fd, write_fd)
+
+    @staticmethod
+    def create(jobs, style = 'pipe'):
+        """
+            Create a jobserver with 'jobs' tokens (including the
+            implicit one) for this process and its children.  The
+            'pipe' style works with all versions of GNU make which
+            support '--jobserver-auth', the 'fifo' style requires make
+            4.4 or later but does not need file descriptors to be
+            inherited.
+        """
+        if style == 'fifo':
+            import tempfile
+            fifo_dir = tempfile.mkdtemp(prefix = 'bakery-jobserver-')
+            fifo = os.path.join(fifo_dir, 'fifo')
+            os.mkfifo(fifo, stat.S_IRUSR | stat.S_IWUSR)
+            read_fd = write_fd = os.open(fifo, os.O_RDWR)
+            auth = 'fifo:%s' % fifo
+        else:
+            fifo = None
+            read_fd, write_fd = os.pipe()
+            os.set_inheritable(read_fd, True)
+            os.set_inheritable(write_fd, True)
+            auth = '%d,%d' % (read_fd, write_fd)
+
+        if jobs > 1:
+            os.write(write_fd, TOKEN * (jobs - 1))
+
+        makeflags = [arg for arg in os.environ.get('MAKEFLAGS', '').split()
+                     if not arg.startswith(JOBSERVER_FLAGS) and not arg.startswith('-j')]
+        makeflags.extend(['-j%d' % jobs, '--jobserver-auth=%s' % auth])
+        return Jobserver(read_fd, write_fd, makeflags = ' '.join(makeflags), fifo = fifo)
+
+    def acquire(self):
+        """
+            Acquire a job token, blocking until one is available.
+        """
+        with self.lock:
+            if self.implicit_free and os.getpid() == self.pid:
+                self.implicit_free = False
+                return IMPLICIT_TOKEN
+        return self._read_token()
+
+    def _read_token(self):
+        while True:
+            try:
+                token = os.read(self.read_fd, 1)
+                if token:
+                    with self.lock:
+                        self.held += 1
+                    return token
+            except BlockingIOError:
+                pass
+            select.select([self.read_fd], [], [])
+
+    def release(self, token):
+        """
+            Return a job token acquired via 'acquire()'.
+        """
+        if token is IMPLICIT_TOKEN:
+            with self.lock:
+                self.implicit_free = True
+        else:
+            with self.lock:
+                self.held -= 1
+            os.write(self.write_fd, token)
+
+    def release_all(self):
+        """
+            Return every token read by this process to the jobserver,
+            e.g. when a worker process is terminated while running a
+            command.  Does not take the lock, so that it is safe to
+            call from a signal handler.
+        """
+        if self.held > 0:
+            os.write(self.write_fd, TOKEN * self.held)
+            self.held = 0
+
+    @contextlib.contextmanager
+    def slot(self):
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    @contextlib.contextmanager
+    def lend(self):
+        """
+            Lend this process' implicit token, if it is free, to forked
+            worker processes while this process waits on them.  Without
+            this, workers could never run a job when '-j1' is in effect.
+        """
+        with self.lock:
+            lending = self.implicit_free and os.getpid() == self.pid
+            self.implicit_free = self.implicit_free and not lending
+        if lending:
+            os.write(self.write_fd, TOKEN)
+        try:
+            yield
+        finally:
+            if lending:
+                self._read_token()
+                with self.lock:
+                    self.held -= 1
+                    self.implicit_free = True
+
+    def environment(self):
+        """
+            Returns the environment for child processes, or None if
+            they should inherit this process' environment as is.
+        """
+        if self.makeflags is None:
+            return None
+        env = dict(os.environ)
+        env['MAKEFLAGS'] = self.makeflags
+        return env
+
+    def pass_fds(self):
+        """
+            Returns the file descriptors child processes need to
+            inherit to take part in the jobserver.
+        """
+        if self.fifo is not None:
+            return ()
+        return tuple(sorted({self.read_fd, self.write_fd}))
+
+    def close(self):
+        if self.fifo is not None:
+            import shutil
+            shutil.rmtree(os.path.dirname(self.fifo), ignore_errors = True)
+        if self.makeflags is not None and os.getpid() == self.pid:
+            for fd in {self.read_fd, self.write_fd}:
+                with contextlib.suppress(OSError):
+                    os.close(fd)
+
+#--------------------------------------------------------------------
+_jobserver = None
+
+#--------------------------------------------------------------------
+def get_jobserver():
+    return _jobserver
+
+#--------------------------------------------------------------------
+def setup_jobserver(jobs, style = 'pipe'):
+    """
+        Join the jobserver of a parent make if there is one, otherwise
+        create one with 'jobs' tokens unless 'style' is 'off'.
+    """
+    global _jobserver
+    if _jobserver is not None:
+        return _jobserver
+    _jobserver = Jobserver.from_makeflags(os.environ.get('MAKEFLAGS'))
+    if _jobserver is None and style != 'off':
+        _jobserver = Jobserver.create(jobs, style)
+        atexit.register(_jobserver.close)
+    return _jobserver
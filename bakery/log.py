@@ -5,53 +5,273 @@
 # Date: Friday, May 19 2017
 #--------------------------------------------------------------------
 
-from termcolor import colored
-import multiprocessing_on_dill as multiprocessing
-from .util import *
+import contextlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
 
 #--------------------------------------------------------------------
-log_lock = multiprocessing.Lock()
+def colored(text, *args, **kwargs):
+    from termcolor import colored
+    return colored(text, *args, **kwargs)
+
+#--------------------------------------------------------------------
+class ConsoleSink:
+    """
+        Writes log events to the console.  In quiet mode only errors,
+        warnings and the output of commands are written.
+    """
+    STYLES = {
+        'target':  ('====>', (), (), ('magenta',)),
+        'task':    ('-->', (), (), ('cyan',)),
+        'error':   ('[ERROR]', ('red',), ('bold',), ('white', 'on_red')),
+        'warning': ('[WARNING]', (), (), ('yellow',)),
+        'success': ('====>', (), ('bold',), ('green',))
+    }
+    QUIET_LEVELS = ('error', 'warning', 'output')
+
+    def __init__(self, quiet = False):
+        self.quiet = quiet
+
+    def write(self, event):
+        level = event['level']
+        if self.quiet and level not in ConsoleSink.QUIET_LEVELS:
+            return
+        if level == 'output':
+            if event.get('stdout'):
+                sys.stdout.write(event['stdout'])
+                sys.stdout.flush()
+            if event.get('stderr'):
+                sys.stderr.write(event['stderr'])
+                sys.stderr.flush()
+            return
+        prefix, colors, attrs, prefix_colors = ConsoleSink.STYLES[level]
+        sys.stdout.write('%s %s\n' % (colored(prefix, *prefix_colors, attrs = ('bold',)),
+                                      colored(event['message'], *colors, attrs = attrs)))
+        sys.stdout.flush()
+
+    def close(self):
+        pass
+
+#--------------------------------------------------------------------
+class JsonlSink:
+    """
+        Appends each log event to a file as a line of JSON.
+    """
+    def __init__(self, filename):
+        self.outfile = open(filename, 'a')
+
+    def write(self, event):
+        self.outfile.write(json.dumps(event) + '\n')
+        self.outfile.flush()
+
+    def close(self):
+        self.outfile.close()
+
+#--------------------------------------------------------------------
+class LogWriter:
+    """
+        Writes all log events and command output from the process
+        running the build, so that messages from concurrent tasks never
+        interleave and worker processes never contend with each other
+        for the console.
+
+        Events from threads in this process are written as they are
+        emitted, in order with anything else the build prints.  Once
+        'share()' is called, before forking any worker processes, the
+        workers send their events through a multiprocessing queue to
+        a relay thread, which writes them instead.
+
+        Events are sent by the emitting thread, so that they are in the
+        queue before the worker reports its task as complete.  A worker
+        which is terminated while sending an event must wait until it
+        has been sent, see 'defer()', or it would leave the queue's
+        lock held and a partial event in the queue.
+    """
+    _instance = None
+
+    @staticmethod
+    def get():
+        if LogWriter._instance is None:
+            LogWriter._instance = LogWriter()
+        return LogWriter._instance
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.shared = None
+        self.relay = None
+        self.sending = False
+        self.deferred = None
+        self.sinks = [ConsoleSink()]
+        self.flush_ids = itertools.count()
+        self.flushed = {}
+        os.register_at_fork(after_in_child = self._after_fork)
+
+    def _after_fork(self):
+        # Another thread may have held the lock when the process forked.
+        self.lock = threading.Lock()
+
+    def configure(self, quiet = False, jsonl = None):
+        """
+            Sets whether the console is quiet and, optionally, the file
+            to which events are also appended as JSON lines.
+        """
+        self.flush()
+        with self.lock:
+            for sink in self.sinks:
+                sink.close()
+            self.sinks = [ConsoleSink(quiet)]
+            if jsonl:
+                self.sinks.append(JsonlSink(jsonl))
+
+    def share(self):
+        """
+            Prepare to receive events from worker processes.  Must be
+            called before they are forked.
+        """
+        with self.lock:
+            if self.shared is None:
+                # Imported here as most builds never fork any workers.
+                import multiprocessing_on_dill as multiprocessing
+                self.shared = multiprocessing.SimpleQueue()
+                self.relay = threading.Thread(target = self._relay_events, name = 'bakery-log', daemon = True)
+                self.relay.start()
+
+    def emit(self, event):
+        event.setdefault('time', time.time())
+        event.setdefault('pid', os.getpid())
+        if os.getpid() != self.pid and self.shared is not None:
+            self._send(event)
+        else:
+            self._write(event)
+
+    def _send(self, event):
+        self.sending = True
+        try:
+            self.shared.put(event)
+        finally:
+            self.sending = False
+        if self.deferred is not None:
+            self.deferred()
+
+    def defer(self, f):
+        """
+            Called from a signal handler to run 'f' once the event being
+            sent, if any, has been sent.  Returns True if 'f' was
+            deferred, in which case the handler should return at once.
+        """
+        if not self.sending:
+            return False
+        self.deferred = f
+        return True
+
+    def flush(self):
+        """
+            Wait until every event sent by worker processes which have
+            exited has been written.
+        """
+        if os.getpid() != self.pid or self.relay is None or not self.relay.is_alive():
+            return
+        flush_id = next(self.flush_ids)
+        done = self.flushed[flush_id] = threading.Event()
+        self.shared.put({'flush': flush_id})
+        done.wait()
+        del self.flushed[flush_id]
+
+    def _write(self, event):
+        with self.lock:
+            for sink in self.sinks:
+                try:
+                    sink.write(event)
+                except Exception as e:
+                    sys.stderr.write('Unable to write log event: %s\n' % str(e))
+
+    def _relay_events(self):
+        while True:
+            try:
+                event = self.shared.get()
+            except (EOFError, OSError):
+                return
+            if 'flush' in event:
+                self.flushed[event['flush']].set()
+            else:
+                self._write(event)
+
+#--------------------------------------------------------------------
+_capture = threading.local()
+
+#--------------------------------------------------------------------
+@contextlib.contextmanager
+def capture_output(name):
+    """
+        Collects the output of every command run by the current thread
+        within the 'with' statement, writing it out as a single block
+        once the statement completes, so that the output of concurrent
+        tasks is never interleaved.
+    """
+    stack = _capture.__dict__.setdefault('stack', [])
+    block = {'level': 'output', 'task': name, 'stdout': '', 'stderr': ''}
+    stack.append(block)
+    try:
+        yield
+    finally:
+        stack.pop()
+        if block['stdout'] or block['stderr']:
+            LogWriter.get().emit(block)
+
+#--------------------------------------------------------------------
+def write_output(stdout, stderr):
+    """
+        Writes the output of a command, as part of the block of the
+        task capturing output on this thread if there is one.
+    """
+    stack = getattr(_capture, 'stack', None)
+    if stack:
+        stack[-1]['stdout'] += stdout
+        stack[-1]['stderr'] += stderr
+    elif stdout or stderr:
+        LogWriter.get().emit({'level': 'output', 'stdout': stdout, 'stderr': stderr})
 
 #--------------------------------------------------------------------
 class BuildLog:
     @staticmethod
     def get(obj, log = False):
-        return BuildLog(log_for(obj) if log else None)
+        if log:
+            from .util import log_for
+            return BuildLog(log_for(obj))
+        return BuildLog(None)
 
     def __init__(self, logger):
         self.logger = logger
 
-    def message(self, prefix, msg, colors = (), attrs = (), prefix_colors = (), prefix_attrs = ('bold',)):
-        print(colored(prefix, *prefix_colors, attrs = prefix_attrs),
-              colored(msg, *colors, attrs = attrs))
+    def message(self, level, msg):
+        LogWriter.get().emit({'level': level, 'message': msg})
 
     def target(self, msg):
-        with log_lock:
-            self.message('====>', msg, prefix_colors = ('magenta',))
-            if self.logger:
-                self.logger.info('====> %s' % msg)
+        self.message('target', msg)
+        if self.logger:
+            self.logger.info('====> %s' % msg)
 
     def task(self, msg):
-        with log_lock:
-            self.message('-->', msg, prefix_colors = ('cyan',))
-            if self.logger:
-                self.logger.info(msg)
+        self.message('task', msg)
+        if self.logger:
+            self.logger.info(msg)
 
     def error(self, msg):
-        with log_lock:
-            self.message('[ERROR]', msg, colors = ('red',), attrs = ('bold',), prefix_colors = ('white', 'on_red'))
-            if self.logger:
-                self.logger.error(msg)
+        self.message('error', msg)
+        if self.logger:
+            self.logger.error(msg)
 
     def warning(self, msg):
-        with log_lock:
-            self.message('[WARNING]', msg, prefix_colors = ('yellow',))
-            if self.logger:
-                self.logger.warn(msg)
+        self.message('warning', msg)
+        if self.logger:
+            self.logger.warn(msg)
 
     def success(self, msg):
-        with log_lock:
-            self.message('====>', msg, prefix_colors = ('green',), attrs = ('bold',))
-            if self.logger:
-                self.logger.info('====> %s' % msg)
-
+        self.message('success', msg)
+        if self.logger:
+            self.logger.info('====> %s' % msg)
@@ -5,13 +5,255 @@
 # Date: Tuesday, April 4 2017
 #--------------------------------------------------------------------
 
-import multiprocessing_on_dill as multiprocessing
-from .work import TaskQueue
+import collections
+import itertools
+import os
+import signal
+import threading
+
+from .engine import get_engine
+from .error import BuildError
+from .jobserver import get_jobserver
+from .log import LogWriter
+
+#--------------------------------------------------------------------
+class PoolError(BuildError):
+    pass
+
+#--------------------------------------------------------------------
+def _terminate_worker(signum, frame):
+    if LogWriter.get().defer(lambda: _terminate_worker(signum, None)):
+        return
+    # Take any running commands down with the worker and give back
+    # their jobserver tokens, so cancelled builds don't leak either.
+    get_engine().terminate()
+    jobserver = get_jobserver()
+    if jobserver is not None:
+        jobserver.release_all()
+    os._exit(128 + signum)
+
+#--------------------------------------------------------------------
+def _init_worker():
+    jobserver = get_jobserver()
+    if jobserver is not None:
+        jobserver.held = 0
+    signal.signal(signal.SIGTERM, _terminate_worker)
 
 #--------------------------------------------------------------------
-process_pool = multiprocessing.Pool()
+def _run_chunk(f, chunk):
+    return [f(x) for x in chunk]
+
+#--------------------------------------------------------------------
+class WorkerPool:
+    """
+        A pool of workers for running the tasks of a ParallelTaskQueue,
+        created on first use rather than when Bakery is imported so
+        that builds which never run a parallel queue, such as no-op
+        builds and cleans, never start any workers.
+
+        The 'process' backend runs tasks in forked worker processes
+        and suits tasks that spend their time in Python code.  The
+        'thread' backend runs tasks on threads in this process and
+        suits tasks that mostly wait on subprocesses via 'shell()'.
+
+        Every queue running at the same time shares the one pool, see
+        'run_unordered()'.  Work is only handed to the pool when one
+        of its workers is free, so that the tasks of a queue which has
+        failed can be discarded without affecting any other queue.
+    """
+    BACKENDS = ('process', 'thread')
+
+    def __init__(self, size = None, backend = 'process', chunksize = 1):
+        if backend not in WorkerPool.BACKENDS:
+            raise PoolError('Unknown worker pool backend: "%s"' % backend)
+        self.size = size
+        self.backend = backend
+        self.chunksize = chunksize
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pid = None
+        # Guards the accounting of work in flight across queues.  Must
+        # be acquired before 'lock' when both are held.
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.queues = 0
+        self.generation = 0
+        os.register_at_fork(after_in_child = self._after_fork)
+
+    def _after_fork(self):
+        # Another thread may have held the locks when the process forked.
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+
+    def get(self):
+        """
+            Returns the underlying pool, creating it if necessary.
+        """
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                # Imported here as it is slow to import and most
+                # builds never need a pool.
+                import multiprocessing_on_dill as multiprocessing
+                import multiprocessing_on_dill.pool
+                if self.backend == 'thread':
+                    self.pool = multiprocessing_on_dill.pool.ThreadPool(self.size)
+                else:
+                    LogWriter.get().share()
+                    self.pool = multiprocessing.Pool(self.size, initializer = _init_worker)
+                self.pid = os.getpid()
+            return self.pool
+
+    def is_started(self):
+        return self.pool is not None and self.pid == os.getpid()
+
+    def capacity(self):
+        return self.size or os.cpu_count() or 1
+
+    def map(self, f, iterable):
+        return self.get().map(f, iterable)
+
+    def run_unordered(self, f, iterable, chunksize = None):
+        """
+            Yields the results of 'f' applied to each item in 'iterable'
+            as they complete, sending 'chunksize' items to a worker at
+            a time.  A chunk is only sent once a worker is free, counting
+            the chunks of every queue running on the pool, so concurrent
+            queues share its workers and never queue work behind each
+            other inside it.
+
+            An exception raised by 'f' is raised as soon as its chunk
+            completes, and the items which haven't been sent are
+            discarded.  If no other queue is running on the pool, it is
+            cancelled to terminate the chunks still in flight, otherwise
+            these are left to finish and their results are ignored.
+            Raises PoolError if the pool is cancelled by other means
+            while chunks are in flight.
+        """
+        chunksize = chunksize or self.chunksize
+        items = iter(iterable)
+        results = collections.deque()
+        pending = 0
+        exhausted = False
+        with self.cond:
+            self.queues += 1
+            generation = self.generation
+        try:
+            while True:
+                with self.cond:
+                    if self.generation != generation:
+                        if pending:
+                            raise PoolError('The worker pool was cancelled.')
+                        generation = self.generation
+                    while not exhausted and self.in_flight < self.capacity():
+                        chunk = list(itertools.islice(items, chunksize))
+                        if not chunk:
+                            exhausted = True
+                            break
+                        self._submit(f, chunk, results)
+                        pending += 1
+                    if not results:
+                        if exhausted and pending == 0:
+                            return
+                        self.cond.wait()
+                        continue
+                    succeeded, value = results.popleft()
+                    pending -= 1
+                if not succeeded:
+                    raise value
+                yield from value
+        except BaseException:
+            with self.cond:
+                pool = self._detach() if self.queues == 1 else None
+            self._terminate(pool)
+            raise
+        finally:
+            with self.cond:
+                self.queues -= 1
+
+    def _submit(self, f, chunk, results):
+        # Called with 'cond' held.
+        generation = self.generation
+        def complete(succeeded, value):
+            with self.cond:
+                if generation == self.generation:
+                    self.in_flight -= 1
+                    results.append((succeeded, value))
+                    self.cond.notify_all()
+        self.get().apply_async(_run_chunk, (f, chunk),
+                               callback = lambda value: complete(True, value),
+                               error_callback = lambda e: complete(False, e))
+        self.in_flight += 1
+
+    def _detach(self):
+        # Called with 'cond' held.  Work in flight on the detached pool
+        # is forgotten, and the next chunk sent starts a new pool.
+        self.generation += 1
+        self.in_flight = 0
+        self.cond.notify_all()
+        with self.lock:
+            pool, self.pool = self.pool, None
+            if self.pid != os.getpid():
+                return None
+            return pool
+
+    def _terminate(self, pool):
+        # Called without 'cond' held, as the pool's result handler may
+        # be waiting for it.
+        if pool is None:
+            return
+        if self.backend == 'thread':
+            # Threads can't be killed, but their commands can, and
+            # any further commands they try to run fail at once.
+            owners = {worker.ident for worker in pool._pool}
+            get_engine().terminate(owners)
+            pool.terminate()
+            get_engine().resume(owners)
+        else:
+            pool.terminate()
+
+    def cancel(self):
+        """
+            Discard any queued tasks and terminate those in flight,
+            along with any commands they are running, for every queue
+            running on the pool.  The pool is started again if it is
+            used afterwards.
+        """
+        with self.cond:
+            pool = self._detach()
+        self._terminate(pool)
+
+    def shutdown(self):
+        """
+            Stop the workers once any outstanding tasks are finished.
+            The pool is started again if it is used afterwards.
+        """
+        with self.lock:
+            if self.pool is not None and self.pid == os.getpid():
+                self.pool.close()
+                self.pool.join()
+            self.pool = None
+
+#--------------------------------------------------------------------
+process_pool = WorkerPool()
 
 #--------------------------------------------------------------------
 def get_process_pool():
     return process_pool
 
+#--------------------------------------------------------------------
+def configure_process_pool(size = None, backend = 'process', chunksize = 1):
+    """
+        Set the size and backend of the worker pool.  Takes effect
+        when the pool is next started.
+    """
+    process_pool.chunksize = chunksize
+    if size != process_pool.size or backend != process_pool.backend:
+        if backend not in WorkerPool.BACKENDS:
+            raise PoolError('Unknown worker pool backend: "%s"' % backend)
+        process_pool.shutdown()
+        process_pool.size = size
+        process_pool.backend = backend
+
+#--------------------------------------------------------------------
+def shutdown_process_pool():
+    process_pool.shutdown()
@@ -0,0 +1,183 @@
+#--------------------------------------------------------------------
+# bakery.profile: Summarizing where the time in a build was spent.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import json
+import os
+import resource
+import sys
+
+from .db import DATABASE_DIR
+
+#--------------------------------------------------------------------
+PROFILE_FILENAME = os.path.join(DATABASE_DIR, 'profile.json')
+PROFILE_VERSION = 1
+
+# Categories of trace spans which are units of work for the profile.
+WORK_CATEGORIES = ('target', 'clean', 'task')
+
+#--------------------------------------------------------------------
+def children_cpu_time():
+    """
+        Returns the CPU time used so far by terminated child processes
+        of this process, i.e. commands and pool workers.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+#--------------------------------------------------------------------
+def _seconds(us):
+    return us / 1000000.0
+
+#--------------------------------------------------------------------
+class BuildProfile:
+    """
+        Summarizes the trace events recorded during a build: the wall
+        and thread CPU time of each target and queued task, the time
+        spent checking whether tasks are done and resolving targets
+        through the injector, the critical path through the dependency
+        graph and the parallelism achieved.
+
+        The ideal parallelism is estimated as the total work divided by
+        the length of the critical path, limited by the number of jobs.
+        Work is the time spent in queued tasks and in targets which are
+        not task queues, so that queues aren't counted twice.
+
+        Only events from the last 'build' span on are considered, as
+        a Bakefile may contain several builds.
+    """
+    def __init__(self, events, dep_graph, jobs, cpu = 0.0, children_cpu = 0.0):
+        events = [e for e in events if e.get('ph') == 'X']
+        start = max((e['ts'] for e in events if e['cat'] == 'build' and e['name'] == 'build'), default = 0)
+        self.events = [e for e in events if e['ts'] >= start]
+        self.dep_graph = dep_graph or {}
+        self.jobs = jobs
+        self.cpu = cpu
+        self.children_cpu = children_cpu
+
+    def spans(self, *categories):
+        return [e for e in self.events if e['cat'] in categories]
+
+    def _total(self, category):
+        spans = self.spans(category)
+        return {'count': len(spans), 'wall': _seconds(sum(e['dur'] for e in spans))}
+
+    def wall_time(self):
+        builds = [e for e in self.spans('build') if e['name'] == 'build']
+        if builds:
+            return _seconds(max(e['dur'] for e in builds))
+        if not self.events:
+            return 0.0
+        return _seconds(max(e['ts'] + e['dur'] for e in self.events) - min(e['ts'] for e in self.events))
+
+    def entries(self):
+        """
+            Returns the targets and tasks profiled, slowest first.
+        """
+        entries = [{'name': e['name'],
+                    'kind': 'task' if e['cat'] == 'task' else 'target',
+                    'wall': _seconds(e['dur']),
+                    'cpu': _seconds(e.get('tdur', 0)),
+                    'queue': bool(e['args'].get('queue'))}
+                   for e in self.spans(*WORK_CATEGORIES)]
+        return sorted(entries, key = lambda entry: entry['wall'], reverse = True)
+
+    def work(self):
+        return sum(entry['wall'] for entry in self.entries() if not entry['queue'])
+
+    def critical_path(self):
+        """
+            Returns the longest chain of dependent targets, weighted by
+            the time spent evaluating each, as (seconds, [targets]) with
+            the first target to be evaluated first.
+        """
+        durations = {}
+        for e in self.spans('target', 'clean'):
+            durations[e['name']] = durations.get(e['name'], 0.0) + _seconds(e['dur'])
+
+        finish = {}
+        chain = {}
+        def visit(target):
+            todo = [target]
+            while todo:
+                current = todo[-1]
+                deps = [dep for dep in self.dep_graph.get(current, ()) if dep not in finish]
+                if deps:
+                    todo.extend(deps)
+                    continue
+                todo.pop()
+                if current in finish:
+                    continue
+                longest = max(self.dep_graph.get(current, ()), key = lambda dep: finish[dep], default = None)
+                finish[current] = durations.get(current, 0.0) + (finish[longest] if longest else 0.0)
+                chain[current] = longest
+
+        for target in self.dep_graph:
+            visit(target)
+        for target in durations:
+            if target not in finish:
+                finish[target] = durations[target]
+                chain[target] = None
+
+        if not finish:
+            return 0.0, []
+        target = max(finish, key = lambda t: finish[t])
+        length = finish[target]
+        path = []
+        while target is not None:
+            if durations.get(target):
+                path.append(target)
+            target = chain[target]
+        return length, list(reversed(path))
+
+    def to_json(self):
+        wall = self.wall_time()
+        work = self.work()
+        path_length, path = self.critical_path()
+        entries = self.entries()
+        return {
+            'version': PROFILE_VERSION,
+            'wall': wall,
+            'jobs': self.jobs,
+            'work': work,
+            'cpu': {
+                'bakery': self.cpu,
+                'children': self.children_cpu
+            },
+            'is_done': self._total('check'),
+            'resolve': self._total('resolve'),
+            'critical_path': {'wall': path_length, 'targets': path},
+            'parallelism': {
+                'achieved': work / wall if wall else 0.0,
+                'ideal': min(self.jobs, work / path_length) if path_length else 1.0
+            },
+            'entries': entries
+        }
+
+    def save(self, filename):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok = True)
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'w') as outfile:
+            json.dump(self.to_json(), outfile, indent = 2)
+        os.replace(tmp_filename, filename)
+
+    def print_report(self, top = 10, outfile = sys.stderr):
+        data = self.to_json()
+        outfile.write('Build profile:\n')
+        outfile.write('    %-40s %9s %9s\n' % ('TARGET / TASK', 'WALL (s)', 'CPU (s)'))
+        for entry in data['entries'][:top]:
+            name = entry['name'] if entry['kind'] == 'target' else '  ' + entry['name']
+            outfile.write('    %-40s %9.3f %9.3f\n' % (name[:40], entry['wall'], entry['cpu']))
+        outfile.write('\n')
+        outfile.write('    %-40s %9.3f\n' % ('Build wall time', data['wall']))
+        outfile.write('    %-40s %9.3f\n' % ('Bakery CPU time', data['cpu']['bakery']))
+        outfile.write('    %-40s %9.3f\n' % ('Child process CPU time', data['cpu']['children']))
+        outfile.write('    %-40s %9.3f (%d)\n' % ('is_done() checks', data['is_done']['wall'], data['is_done']['count']))
+        outfile.write('    %-40s %9.3f (%d)\n' % ('Injector resolution', data['resolve']['wall'], data['resolve']['count']))
+        outfile.write('    %-40s %9.3f %s\n' % ('Critical path', data['critical_path']['wall'],
+                                                ' -> '.join(data['critical_path']['targets'])))
+        outfile.write('    %-40s %9.2f of %.2f ideal (%d jobs)\n' % (
+            'Parallelism', data['parallelism']['achieved'], data['parallelism']['ideal'], self.jobs))
@@ -0,0 +1,21 @@
+#--------------------------------------------------------------------
+# bakery.recipe: Recipes for building common types of projects.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import importlib
+
+#--------------------------------------------------------------------
+RECIPES = ('c', 'cpp', 'os')
+
+#--------------------------------------------------------------------
+def __getattr__(name):
+    """
+        Imports recipe modules on first access, so that 'bakery.recipe.c'
+        works without importing every recipe up front.
+    """
+    if name in RECIPES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
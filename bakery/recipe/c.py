@@ -5,25 +5,102 @@
 # Date: Thursday, March 23 2017
 #--------------------------------------------------------------------
 
+import contextlib
+import os
+
 from xeno import provide
 
 from ..core import *
-from ..file import File, FileTask
+from ..db import BuildDatabase
+from ..file import File, FileTask, collect_files, parse_depfile
 from ..log import BuildLog
+from ..util import flat_map
 from ..work import shell
+from ..cache import compile_key
+from ..remote import get_executor
 
 #--------------------------------------------------------------------
 class ObjectMaker(FileTask):
     def __init__(self, src, config):
         super().__init__(File.change_ext(src, 'o'))
         self.src = File.as_file(src)
+        self.depfile = File.change_ext(src, 'd')
         self.config = config
+        self.key = None
+
+    def inputs(self):
+        return [self.src]
+
+    def discovered_inputs(self):
+        return parse_depfile(self.depfile.abspath())
+
+    def outputs(self):
+        return [self.file, self.depfile]
+
+    def cached_outputs(self):
+        return [self.file]
+
+    def cache_key(self):
+        # Memoized until 'invalidate()', so that the source is only
+        # preprocessed once when both the local and shared caches are used.
+        if self.key is None:
+            self.key = compile_key(self.config.CC, self.config.CFLAGS, self.src.relpath(), self.depfile)
+        return self.key
+
+    def signature(self):
+        return [self.config.CC, self.config.CFLAGS]
+
+    def batch_key(self):
+        """
+            When batching is enabled, sources in the same directory are
+            compiled together by one compiler invocation per worker, see
+            'run_batch()'.  Cached and remote compiles are never batched.
+        """
+        if not self.config.batch or self.config.cache is not None or FileTask.cache is not None:
+            return None
+        if get_executor() is not None:
+            return None
+        return (self.config.CC, tuple(str(x) for x in flat_map(self.config.CFLAGS)),
+                os.path.dirname(self.file.abspath()))
+
+    @staticmethod
+    def run_batch(tasks):
+        """
+            Compiles the sources of the given ObjectMakers, which share
+            a 'batch_key()', with a single compiler invocation run in
+            their directory, where it writes the objects and depfiles.
+        """
+        config = tasks[0].config
+        for task in tasks:
+            BuildLog.get(task).task('Compiling C: %s' % task.src.relpath())
+        return FileTask.build_together(tasks, lambda: shell(
+            config.CC, config.CFLAGS, '-MMD', '-c', [task.src for task in tasks],
+            cwd = os.path.dirname(tasks[0].file.abspath()), check = False, response_file = True))
 
     def run(self):
         BuildLog.get(self).task('Compiling C: %s' % self.src.relpath())
-        shell(self.config.CC, self.config.CFLAGS, '-c', self.src, '-o', self.file)
+        if self.config.cache is not None:
+            self.config.cache.run(self.cache_key(), self.cached_outputs(), self.compile)
+        else:
+            self.compile()
         return self.file
 
+    def compile(self):
+        executor = get_executor()
+        if executor is not None:
+            executor.compile(self.config.CC, self.config.CFLAGS, self.src, self.file, self.depfile, 'cpp-output')
+        else:
+            shell(self.config.CC, self.config.CFLAGS, '-MMD', '-MF', self.depfile, '-c', self.src, '-o', self.file,
+                  response_file = True)
+
+    def invalidate(self):
+        super().invalidate()
+        self.key = None
+
+    def clean(self):
+        super().clean()
+        self.depfile.clean()
+
 #--------------------------------------------------------------------
 class ExecutableMaker(FileTask):
     def __init__(self, objects, output, config):
@@ -31,9 +108,62 @@ class ExecutableMaker(FileTask):
         self.objects = objects
         self.config = config
 
+    def inputs(self):
+        return collect_files(self.objects)
+
+    def signature(self):
+        return [self.config.CC, self.config.CFLAGS, self.config.LDFLAGS]
+
     def run(self):
         BuildLog.get(self).task('Linking executable: %s' % self.file.relpath())
-        shell(self.config.CC, self.config.CFLAGS, self.config.LDFLAGS, '-o', self.file, self.objects)
+        shell(self.config.CC, self.config.CFLAGS, self.config.LDFLAGS, '-o', self.file, self.objects,
+              response_file = True)
+        return self.file
+
+#--------------------------------------------------------------------
+class ArchiveMaker(FileTask):
+    """
+        Archives objects into a static library.  An existing archive
+        is updated in place, replacing only the members whose objects
+        have changed since it was last built.  It is created anew if
+        any objects were removed, or if the names of the members
+        wouldn't be unique, as a plain archive only keeps the base
+        name of each object.
+
+        A thin archive refers to its objects by path rather than
+        containing copies of them.
+    """
+    def __init__(self, objects, output, config, thin = False):
+        super().__init__(File.as_file(output))
+        self.objects = objects
+        self.config = config
+        self.thin = thin
+
+    def inputs(self):
+        return collect_files(self.objects)
+
+    def signature(self):
+        return [self.config.AR, self.thin]
+
+    def cache_key(self):
+        # A thin archive is only valid alongside its objects.
+        return None if self.thin else super().cache_key()
+
+    def run(self):
+        objects = self.inputs()
+        changed = BuildDatabase.get().changed_inputs(self) if self.file.exists() else None
+        if changed is None or (not self.thin and
+                               len({os.path.basename(f.abspath()) for f in objects}) < len(objects)):
+            BuildLog.get(self).task('Creating archive: %s' % self.file.relpath())
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.file.abspath())
+            changed = objects
+        else:
+            BuildLog.get(self).task('Updating archive: %s (%d of %d objects)' % (
+                self.file.relpath(), len(changed), len(objects)))
+        if changed or not self.file.exists():
+            shell(self.config.AR, 'rcsT' if self.thin else 'rcs', self.file, changed,
+                  response_file = True)
         return self.file
 
 #--------------------------------------------------------------------
@@ -42,6 +172,14 @@ class Config:
         self.CC = 'clang'
         self.CFLAGS = []
         self.LDFLAGS = []
+        self.AR = 'ar'
+        # An optional bakery.cache.Cache for compiled objects.
+        self.cache = None
+        # Compile out of date sources in the same directory together,
+        # one compiler invocation per worker.  The compiler is run in
+        # the sources' directory, so include paths in CFLAGS should be
+        # absolute.
+        self.batch = False
 
 #--------------------------------------------------------------------
 class Builder:
@@ -54,6 +192,9 @@ class Builder:
     def link(self, objects, output):
         return ExecutableMaker(objects, output, self.config)
 
+    def archive(self, objects, output, thin = False):
+        return ArchiveMaker(objects, output, self.config, thin)
+
 #--------------------------------------------------------------------
 @namespace('recipe/c')
 class Module:
@@ -5,25 +5,218 @@
 # Date: Thursday, March 23 2017
 #--------------------------------------------------------------------
 
+import collections
+import fnmatch
+import os
+
 from xeno import provide, singleton
 
 from ..core import *
-from ..file import File, FileTask
+from ..db import file_digest
+from ..file import File, FileTask, collect_files, parse_depfile
 from ..log import BuildLog
+from ..util import flat_map
 from ..work import shell
+from ..cache import cache_key, compile_key
+from ..remote import get_executor
+from .c import ArchiveMaker
+
+#--------------------------------------------------------------------
+class PchMaker(FileTask):
+    """
+        Precompiles a header with the compiler and flags of the given
+        config, see 'Builder.pch()'.  Clang's precompiled header is
+        written to 'header.pch' and included via '-include-pch', GCC's
+        is written to 'header.gch', where GCC finds it when the header
+        is included via '-include'.
+    """
+    def __init__(self, header, config):
+        self.header = File.as_file(header)
+        self.clang = 'clang' in os.path.basename(config.CXX)
+        super().__init__(File('%s.%s' % (self.header, 'pch' if self.clang else 'gch')))
+        self.depfile = File('%s.d' % self.file)
+        self.config = config
+
+    def inputs(self):
+        return [self.header]
+
+    def discovered_inputs(self):
+        return parse_depfile(self.depfile.abspath())
+
+    def outputs(self):
+        return [self.file, self.depfile]
+
+    def signature(self):
+        return [self.config.CXX, self.config.CXXFLAGS]
+
+    def include_flags(self):
+        """
+            Returns the flags for compiling a source with this header
+            precompiled.
+        """
+        if self.clang:
+            return ['-include-pch', self.file]
+        return ['-include', self.header]
+
+    def run(self):
+        BuildLog.get(self).task('Precompiling header: %s' % self.header.relpath())
+        shell(self.config.CXX, self.config.CXXFLAGS, '-x', 'c++-header', self.header,
+              '-MMD', '-MF', self.depfile, '-o', self.file, response_file = True)
+        return self.file
+
+    def clean(self):
+        super().clean()
+        self.depfile.clean()
 
 #--------------------------------------------------------------------
 class ObjectMaker(FileTask):
     def __init__(self, src, config):
         super().__init__(File.change_ext(src, 'o'))
         self.src = File.as_file(src)
+        self.depfile = File.change_ext(src, 'd')
         self.config = config
+        self.key = None
+
+    def inputs(self):
+        return [self.src, *self.pch_inputs()]
+
+    def pch_inputs(self):
+        return [self.config.pch.file] if self.config.pch is not None else []
+
+    def flags(self):
+        """
+            Returns the compiler flags for this object, including those
+            for the config's precompiled header if it has one.
+        """
+        if self.config.pch is None:
+            return self.config.CXXFLAGS
+        return [self.config.CXXFLAGS, self.config.pch.include_flags()]
+
+    def discovered_inputs(self):
+        return parse_depfile(self.depfile.abspath())
+
+    def outputs(self):
+        return [self.file, self.depfile]
+
+    def cached_outputs(self):
+        return [self.file]
+
+    def cache_key(self):
+        # Memoized until 'invalidate()', so that the source is only
+        # preprocessed once when both the local and shared caches are used.
+        if self.key is None:
+            self.key = compile_key(self.config.CXX, self.flags(), self.src.relpath(), self.depfile)
+            pch = self.config.pch
+            if pch is not None and pch.clang:
+                # '-include-pch' leaves the header out of the preprocessed source.
+                self.key = cache_key(self.key, file_digest(pch.file.abspath()))
+        return self.key
+
+    def signature(self):
+        return [self.config.CXX, self.config.CXXFLAGS]
+
+    def batch_key(self):
+        """
+            When batching is enabled, sources in the same directory are
+            compiled together by one compiler invocation per worker, see
+            'run_batch()'.  Cached and remote compiles are never batched.
+        """
+        if not self.config.batch or self.config.cache is not None or FileTask.cache is not None:
+            return None
+        if get_executor() is not None:
+            return None
+        return (self.config.CXX, tuple(str(x) for x in flat_map(self.config.CXXFLAGS)),
+                os.path.dirname(self.file.abspath()))
+
+    @staticmethod
+    def run_batch(tasks):
+        """
+            Compiles the sources of the given ObjectMakers, which share
+            a 'batch_key()', with a single compiler invocation run in
+            their directory, where it writes the objects and depfiles.
+        """
+        config = tasks[0].config
+        for task in tasks:
+            BuildLog.get(task).task('Compiling C++: %s' % task.src.relpath())
+        return FileTask.build_together(tasks, lambda: shell(
+            config.CXX, tasks[0].flags(), '-MMD', '-c', [task.src for task in tasks],
+            cwd = os.path.dirname(tasks[0].file.abspath()), check = False, response_file = True))
 
     def run(self):
         BuildLog.get(self).task('Compiling C++: %s' % self.src.relpath())
-        shell(self.config.CXX, self.config.CXXFLAGS, '-c', self.src, '-o', self.file)
+        if self.config.cache is not None:
+            self.config.cache.run(self.cache_key(), self.cached_outputs(), self.compile)
+        else:
+            self.compile()
         return self.file
 
+    def compile(self):
+        executor = get_executor()
+        if executor is not None:
+            # Precompiled headers are local, sources are preprocessed in full for remote workers.
+            flags = self.config.CXXFLAGS
+            if self.config.pch is not None:
+                flags = [flags, '-include', self.config.pch.header]
+            executor.compile(self.config.CXX, flags, self.src, self.file, self.depfile, 'c++-cpp-output')
+        else:
+            shell(self.config.CXX, self.flags(), '-MMD', '-MF', self.depfile, '-c', self.src, '-o', self.file,
+                  response_file = True)
+
+    def invalidate(self):
+        super().invalidate()
+        self.key = None
+
+    def clean(self):
+        super().clean()
+        self.depfile.clean()
+
+#--------------------------------------------------------------------
+class UnityObjectMaker(ObjectMaker):
+    """
+        Compiles a number of sources as a single translation unit, by
+        way of a generated source file which includes each of them, so
+        that the headers they share are parsed only once.  The unity
+        source is rewritten whenever the object is rebuilt, and the
+        object is rebuilt whenever any of the sources, or the list of
+        sources, changes.
+    """
+    def __init__(self, unity_src, sources, config):
+        super().__init__(unity_src, config)
+        self.sources = [File.as_file(src) for src in sources]
+
+    def inputs(self):
+        return [*self.sources, *self.pch_inputs()]
+
+    def signature(self):
+        return [*super().signature(), [src.abspath() for src in self.sources]]
+
+    def batch_key(self):
+        return None
+
+    def unity_source(self):
+        return ''.join('#include "%s"\n' % src.abspath() for src in self.sources)
+
+    def write_unity_source(self):
+        os.makedirs(os.path.dirname(self.src.abspath()), exist_ok = True)
+        with open(self.src.abspath(), 'w') as outfile:
+            outfile.write(self.unity_source())
+        self.src.invalidate()
+
+    def cache_key(self):
+        # The key is computed from the preprocessed unity source, which
+        # must exist before the object is fetched from a shared cache.
+        if self.key is None:
+            self.write_unity_source()
+        return super().cache_key()
+
+    def run(self):
+        self.write_unity_source()
+        return super().run()
+
+    def clean(self):
+        super().clean()
+        self.src.clean()
+
 #--------------------------------------------------------------------
 class ExecutableMaker(FileTask):
     def __init__(self, objects, output, config):
@@ -31,9 +224,16 @@ class ExecutableMaker(FileTask):
         self.objects = objects
         self.config = config
 
+    def inputs(self):
+        return collect_files(self.objects)
+
+    def signature(self):
+        return [self.config.CXX, self.config.CXXFLAGS, self.config.LDFLAGS]
+
     def run(self):
         BuildLog.get(self).task('Linking executable: %s' % self.file.relpath())
-        shell(self.config.CXX, self.config.CXXFLAGS, self.config.LDFLAGS, '-o', self.file, self.objects)
+        shell(self.config.CXX, self.config.CXXFLAGS, self.config.LDFLAGS, '-o', self.file, self.objects,
+              response_file = True)
         return self.file
 
 #--------------------------------------------------------------------
@@ -42,6 +242,17 @@ class Config:
         self.CXX = 'clang++'
         self.CXXFLAGS = []
         self.LDFLAGS = []
+        self.AR = 'ar'
+        # An optional bakery.cache.Cache for compiled objects.
+        self.cache = None
+        # Compile out of date sources in the same directory together,
+        # one compiler invocation per worker.  The compiler is run in
+        # the sources' directory, so include paths in CXXFLAGS should be
+        # absolute.
+        self.batch = False
+        # An optional PchMaker for a header precompiled for every
+        # object, see 'Builder.pch()'.
+        self.pch = None
 
 #--------------------------------------------------------------------
 class Builder:
@@ -51,9 +262,71 @@ class Builder:
     def compile(self, src):
         return ObjectMaker(src, self.config)
 
+    def pch(self, header):
+        """
+            Returns the task precompiling the given header, which every
+            object compiled with this builder's config then uses.  The
+            target compiling the objects should depend on the target
+            providing this task, so that it is built first.
+        """
+        self.config.pch = PchMaker(header, self.config)
+        return self.config.pch
+
+    def unity(self, sources, max_sources = 8, group_by = 'directory', max_size = 256 * 1024,
+              exclude = (), output_dir = 'unity'):
+        """
+            Returns the tasks compiling the given sources as unity
+            builds, for use in a @parallel or @queue target.
+
+            With 'group_by' as 'directory', the sources of each directory
+            are combined into units of up to 'max_sources' sources.  With
+            'group_by' as 'size', sources are combined in order into units
+            of up to 'max_sources' sources and about 'max_size' bytes.
+
+            Sources matching any of the glob patterns or files given in
+            'exclude', e.g. those defining conflicting static symbols,
+            are compiled on their own.  The generated unity sources and
+            their objects are written to 'output_dir'.
+        """
+        if group_by not in ('directory', 'size'):
+            raise BuildError('Unknown unity build grouping: "%s"' % group_by)
+
+        patterns = [File.as_file(x).relpath() if isinstance(x, File) else x for x in exclude]
+        tasks = []
+        groups = collections.OrderedDict()
+        for src in sorted((File.as_file(src) for src in sources), key = lambda src: src.abspath()):
+            if any(fnmatch.fnmatch(src.relpath(), pattern) for pattern in patterns):
+                tasks.append(ObjectMaker(src, self.config))
+            elif group_by == 'directory':
+                groups.setdefault(os.path.dirname(src.relpath()), []).append(src)
+            else:
+                groups.setdefault('', []).append(src)
+
+        for directory, group in groups.items():
+            units = [[]]
+            size = 0
+            for src in group:
+                src_size = os.path.getsize(src.abspath()) if group_by == 'size' and src.exists() else 0
+                if units[-1] and (len(units[-1]) >= max_sources or size + src_size > max_size):
+                    units.append([])
+                    size = 0
+                units[-1].append(src)
+                size += src_size
+            prefix = directory.replace(os.sep, '_').replace('.', '_') or 'unity'
+            for n, unit in enumerate(units):
+                if len(unit) == 1:
+                    tasks.append(ObjectMaker(unit[0], self.config))
+                else:
+                    unity_src = File(os.path.join(output_dir, '%s-%d.cpp' % (prefix, n)))
+                    tasks.append(UnityObjectMaker(unity_src, unit, self.config))
+        return tasks
+
     def link(self, objects, output):
         return ExecutableMaker(objects, output, self.config)
 
+    def archive(self, objects, output, thin = False):
+        return ArchiveMaker(objects, output, self.config, thin)
+
 #--------------------------------------------------------------------
 @namespace('recipe/cpp')
 class Module:
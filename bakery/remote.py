@@ -0,0 +1,379 @@
+#--------------------------------------------------------------------
+# bakery.remote: Distributed execution of commands on bake-worker
+#                daemons over a simple TCP protocol.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import argparse
+import base64
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+from .error import BuildError
+from .log import BuildLog
+from .util import *
+from .work import command_line, shell, shell_output
+
+#--------------------------------------------------------------------
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 7643
+
+# Seconds to wait for a worker to accept a connection and say hello,
+# and for any one read or write on a job's connection.  A job which
+# exceeds the latter is retried elsewhere, as its worker is presumed lost.
+CONNECT_TIMEOUT = 10
+DEFAULT_TIMEOUT = 600
+
+# Flags which only affect the preprocessor, and whether they take
+# a separate argument when not joined, e.g. '-I include' vs '-Iinclude'.
+PREPROCESSOR_FLAGS = {
+    '-I': True, '-D': True, '-U': True, '-include': True, '-imacros': True,
+    '-isystem': True, '-iquote': True, '-idirafter': True, '-MF': True,
+    '-MT': True, '-MQ': True, '-MD': False, '-MMD': False, '-MP': False,
+    '-M': False, '-MM': False
+}
+
+#--------------------------------------------------------------------
+class RemoteError(BuildError):
+    pass
+
+#--------------------------------------------------------------------
+def send_message(sock, message):
+    """
+        Sends a JSON message prefixed by its 4 byte big-endian length.
+    """
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+#--------------------------------------------------------------------
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise RemoteError('Connection closed unexpectedly.')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+#--------------------------------------------------------------------
+def recv_message(sock):
+    size, = struct.unpack('>I', _recv_exactly(sock, 4))
+    return json.loads(_recv_exactly(sock, size).decode('utf-8'))
+
+#--------------------------------------------------------------------
+def encode_files(files):
+    return {name: base64.b64encode(data).decode('ascii') for name, data in files.items()}
+
+#--------------------------------------------------------------------
+def decode_files(files):
+    return {name: base64.b64decode(data) for name, data in files.items()}
+
+#--------------------------------------------------------------------
+def safe_join(root, name):
+    """
+        Join a relative file name from a job to the job's root,
+        refusing absolute paths or paths which escape the root.
+    """
+    path = os.path.normpath(os.path.join(root, name))
+    if os.path.isabs(name) or not path.startswith(root + os.sep):
+        raise RemoteError('Refusing unsafe path in job: %s' % name)
+    return path
+
+#--------------------------------------------------------------------
+def compile_flags(flags):
+    """
+        Removes preprocessor-only flags from the given flags, leaving
+        those which apply when compiling already preprocessed source.
+    """
+    results = []
+    skip = False
+    for flag in flags:
+        if skip:
+            skip = False
+        elif flag in PREPROCESSOR_FLAGS:
+            skip = PREPROCESSOR_FLAGS[flag]
+        elif any(flag.startswith(prefix) for prefix, takes_arg in PREPROCESSOR_FLAGS.items() if takes_arg):
+            pass
+        else:
+            results.append(flag)
+    return results
+
+#--------------------------------------------------------------------
+class WorkerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            while True:
+                try:
+                    message = recv_message(self.request)
+                except RemoteError:
+                    return
+                if message.get('type') == 'hello':
+                    send_message(self.request, {
+                        'type': 'hello',
+                        'version': PROTOCOL_VERSION,
+                        'capacity': self.server.capacity
+                    })
+                elif message.get('type') == 'job':
+                    with self.server.slots:
+                        send_message(self.request, self.server.run_job(message))
+                else:
+                    send_message(self.request, {'type': 'error', 'message': 'Unknown message type.'})
+        except (OSError, RemoteError):
+            pass
+
+#--------------------------------------------------------------------
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+        The 'bake-worker' daemon.  Accepts jobs consisting of a command
+        line and a set of input files, runs each in a private temporary
+        directory and returns the requested output files along with the
+        command's output and return code.  At most 'capacity' jobs are
+        run at once, further jobs wait for a free slot.
+
+        Workers run arbitrary commands for anyone that can connect to
+        them and should only be exposed on trusted networks.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, capacity = None):
+        super().__init__(address, WorkerHandler)
+        self.capacity = capacity or os.cpu_count() or 1
+        self.slots = threading.BoundedSemaphore(self.capacity)
+
+    def run_job(self, job):
+        with tempfile.TemporaryDirectory(prefix = 'bake-worker-') as root:
+            try:
+                for name, data in decode_files(job.get('files', {})).items():
+                    path = safe_join(root, name)
+                    os.makedirs(os.path.dirname(path), exist_ok = True)
+                    with open(path, 'wb') as outfile:
+                        outfile.write(data)
+
+                proc = subprocess.run(job['argv'], cwd = root,
+                                      stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+
+                outputs = {}
+                if proc.returncode == 0:
+                    for name in job.get('outputs', []):
+                        with open(safe_join(root, name), 'rb') as infile:
+                            outputs[name] = infile.read()
+
+                return {
+                    'type': 'result',
+                    'returncode': proc.returncode,
+                    'stdout': proc.stdout.decode('utf-8', 'replace'),
+                    'stderr': proc.stderr.decode('utf-8', 'replace'),
+                    'files': encode_files(outputs)
+                }
+
+            except (OSError, RemoteError) as e:
+                return {'type': 'error', 'message': str(e)}
+
+#--------------------------------------------------------------------
+class RemoteWorker:
+    def __init__(self, host, port, capacity):
+        self.host = host
+        self.port = port
+        self.capacity = capacity
+        self.running = 0
+        self.alive = True
+
+    def __str__(self):
+        return '%s:%d' % (self.host, self.port)
+
+#--------------------------------------------------------------------
+class RemoteExecutor:
+    """
+        Coordinates the execution of commands on a set of bake-worker
+        daemons.  Each job is sent to the live worker with the most
+        free slots, waiting for a slot if every worker is busy.  Jobs
+        which fail to be delivered are retried on another worker, or
+        run locally if no workers remain.
+    """
+    def __init__(self, workers, timeout = DEFAULT_TIMEOUT, connect_timeout = CONNECT_TIMEOUT):
+        self.workers = []
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.condition = threading.Condition()
+        os.register_at_fork(after_in_child = self._after_fork)
+        for host, port in workers:
+            try:
+                with socket.create_connection((host, port), timeout = self.connect_timeout) as sock:
+                    send_message(sock, {'type': 'hello', 'version': PROTOCOL_VERSION})
+                    hello = recv_message(sock)
+                self.workers.append(RemoteWorker(host, port, hello['capacity']))
+            except (OSError, RemoteError, KeyError) as e:
+                BuildLog.get(self).warning('Worker %s:%d is unavailable: %s' % (host, port, str(e)))
+
+    def _after_fork(self):
+        # Another thread may have held the condition's lock when the
+        # process forked.
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def parse_workers(spec):
+        """
+            Parses a comma separated list of 'host[:port]' worker addresses.
+        """
+        workers = []
+        for address in spec.split(','):
+            host, sep, port = address.strip().rpartition(':')
+            if not sep:
+                host, port = port, DEFAULT_PORT
+            workers.append((host, int(port)))
+        return workers
+
+    def capacity(self):
+        return sum(worker.capacity for worker in self.workers if worker.alive)
+
+    def _acquire(self):
+        with self.condition:
+            while True:
+                live_workers = [worker for worker in self.workers if worker.alive]
+                if not live_workers:
+                    return None
+                worker = max(live_workers, key = lambda w: w.capacity - w.running)
+                if worker.running < worker.capacity:
+                    worker.running += 1
+                    return worker
+                self.condition.wait()
+
+    def _release(self, worker, alive = True):
+        with self.condition:
+            worker.running -= 1
+            worker.alive = worker.alive and alive
+            self.condition.notify_all()
+
+    def execute(self, argv, files, outputs):
+        """
+            Runs the given command line on a worker with the given map
+            of relative file names to contents as its inputs.  'outputs'
+            maps the relative names of files produced by the command to
+            the local paths they should be written to.  Raises
+            subprocess.CalledProcessError if the command fails.
+        """
+        job = {
+            'type': 'job',
+            'argv': argv,
+            'files': encode_files(files),
+            'outputs': list(outputs.keys())
+        }
+
+        while True:
+            worker = self._acquire()
+            if worker is None:
+                raise RemoteError('No remote workers are available.')
+            try:
+                with socket.create_connection((worker.host, worker.port),
+                                              timeout = self.connect_timeout) as sock:
+                    sock.settimeout(self.timeout)
+                    send_message(sock, job)
+                    result = recv_message(sock)
+            except (OSError, RemoteError) as e:
+                BuildLog.get(self).warning('Lost worker %s: %s' % (worker, str(e)))
+                self._release(worker, alive = False)
+                continue
+            self._release(worker)
+            break
+
+        if result.get('type') != 'result':
+            raise RemoteError('Worker %s failed to run job: %s' % (worker, result.get('message')))
+        sys.stdout.write(result['stdout'])
+        sys.stderr.write(result['stderr'])
+        if result['returncode'] != 0:
+            raise subprocess.CalledProcessError(result['returncode'], argv)
+
+        for name, data in decode_files(result['files']).items():
+            with open(outputs[name], 'wb') as outfile:
+                outfile.write(data)
+        return 0
+
+    def shell(self, *args, inputs = (), outputs = ()):
+        """
+            Runs a command as per 'bakery.work.shell()' on a worker.
+            The given input Files are shipped along with the command
+            and the given output Files are brought back.  References
+            to these files in the command line are rewritten to their
+            paths relative to the current directory.
+        """
+        cmd_line = command_line(*args)
+        renames = {}
+        files = {}
+        for f in inputs:
+            renames[f.abspath()] = f.relpath()
+            with open(f.abspath(), 'rb') as infile:
+                files[f.relpath()] = infile.read()
+        for f in outputs:
+            renames[f.abspath()] = f.relpath()
+        argv = [renames.get(arg, arg) for arg in cmd_line]
+        log = logger_for_function(RemoteExecutor.shell)
+        log.info("Executing remote command: %s" % " ".join(argv))
+        try:
+            return self.execute(argv, files, {f.relpath(): f.abspath() for f in outputs})
+        except RemoteError:
+            return shell(*args)
+
+    def compile(self, compiler, flags, src, obj, depfile, language):
+        """
+            Compiles the given source file remotely in the manner of
+            distcc: the source is preprocessed locally, writing the
+            depfile, and only the preprocessed source is shipped to
+            the worker, so headers need not exist there.
+        """
+        flags = command_line(flags)
+        preprocessed = shell_output(compiler, flags, '-MMD', '-MF', depfile, '-E', src, response_file = True)
+        name = os.path.basename(src.abspath()) + '.i'
+        argv = [str(compiler), *compile_flags(flags), '-x', language, '-c', name, '-o', 'output.o']
+        try:
+            return self.execute(argv, {name: preprocessed}, {'output.o': obj.abspath()})
+        except RemoteError:
+            return shell(compiler, flags, '-MMD', '-MF', depfile, '-c', src, '-o', obj, response_file = True)
+
+#--------------------------------------------------------------------
+_executor = None
+
+#--------------------------------------------------------------------
+def get_executor():
+    """
+        Returns the RemoteExecutor for this build, or None if tasks
+        should be run locally.
+    """
+    return _executor
+
+#--------------------------------------------------------------------
+def set_executor(executor):
+    global _executor
+    _executor = executor
+
+#--------------------------------------------------------------------
+def worker_main():
+    """
+        The main entry point of the 'bake-worker' command line tool.
+    """
+    parser = argparse.ArgumentParser(description = 'Run commands for remote bake coordinators.')
+    parser.add_argument('-H', '--host', default='127.0.0.1')
+    parser.add_argument('-P', '--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    args = parser.parse_args()
+
+    with WorkerServer((args.host, args.port), args.jobs) as server:
+        print('bake-worker listening on %s:%d with %d slots.' % (
+            args.host, server.server_address[1], server.capacity))
+        with contextlib.suppress(KeyboardInterrupt):
+            server.serve_forever()
+
+#--------------------------------------------------------------------
+if __name__ == '__main__':
+    worker_main()
@@ -0,0 +1,158 @@
+#--------------------------------------------------------------------
+# bakery.trace: Recording build timelines in the Chrome trace event
+#               format, viewable in chrome://tracing or Perfetto.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import contextlib
+import glob
+import json
+import os
+import threading
+import time
+
+#--------------------------------------------------------------------
+def _now_us():
+    # Wall clock time, so that events from worker processes line up.
+    return time.time_ns() // 1000
+
+#--------------------------------------------------------------------
+def _thread_now_us():
+    return time.thread_time_ns() // 1000
+
+#--------------------------------------------------------------------
+class Tracer:
+    """
+        Records spans of time as trace events, one lane per process
+        and thread, along with the CPU time used by the thread during
+        each span.  Events are kept in memory by the process which
+        started tracing.  Forked worker processes append their events
+        to a part file next to the trace file instead, and these are
+        merged in when the events are collected.
+
+        If 'filename' is None, events are only collected in memory,
+        e.g. for '--profile', and worker part files are kept in the
+        '.bakery' directory.
+    """
+    def __init__(self, filename = None):
+        self.filename = os.path.abspath(filename) if filename else None
+        self.part_prefix = self.filename or os.path.abspath(os.path.join('.bakery', 'trace'))
+        os.makedirs(os.path.dirname(self.part_prefix), exist_ok = True)
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.events = []
+        self.named_threads = set()
+        os.register_at_fork(after_in_child = self._after_fork)
+
+    def _after_fork(self):
+        # Another thread may have held the lock when the process forked.
+        self.lock = threading.Lock()
+
+    def _part_filename(self, pid):
+        return '%s.%d.part' % (self.part_prefix, pid)
+
+    def _record(self, events):
+        with self.lock:
+            if os.getpid() == self.pid:
+                self.events.extend(events)
+            else:
+                with open(self._part_filename(os.getpid()), 'a') as outfile:
+                    for event in events:
+                        outfile.write(json.dumps(event) + '\n')
+
+    def _lane(self):
+        pid, tid = os.getpid(), threading.get_ident()
+        events = []
+        if (pid, tid) not in self.named_threads:
+            self.named_threads.add((pid, tid))
+            thread_name = threading.current_thread().name
+            if tid == threading.main_thread().ident:
+                events.append({'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': tid,
+                               'args': {'name': 'bake' if pid == self.pid else 'worker %d' % pid}})
+                # A forked worker's main thread keeps the name of the
+                # thread which forked it.
+                thread_name = 'MainThread'
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid,
+                           'args': {'name': thread_name}})
+        return pid, tid, events
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """
+            Records the time spent in the body of the 'with' statement
+            as a complete event with the given name, category and args.
+            The args dict is yielded so that the body may add to it.
+        """
+        start = _now_us()
+        thread_start = _thread_now_us()
+        try:
+            yield args
+        finally:
+            pid, tid, events = self._lane()
+            events.append({'ph': 'X', 'name': name, 'cat': category, 'ts': start,
+                           'dur': _now_us() - start, 'tts': thread_start,
+                           'tdur': _thread_now_us() - thread_start,
+                           'pid': pid, 'tid': tid, 'args': args})
+            self._record(events)
+
+    def collect(self):
+        """
+            Merges the events of any worker processes, returning every
+            event recorded so far.
+        """
+        if os.getpid() != self.pid:
+            return []
+        for part_filename in glob.glob(glob.escape(self.part_prefix) + '.*.part'):
+            with open(part_filename, 'r') as infile:
+                events = [json.loads(line) for line in infile if line.strip()]
+            os.remove(part_filename)
+            with self.lock:
+                self.events.extend(events)
+        with self.lock:
+            return list(self.events)
+
+    def save(self):
+        """
+            Writes out every event recorded so far to the trace file.
+        """
+        events = self.collect()
+        if self.filename is None or os.getpid() != self.pid:
+            return
+        with self.lock:
+            data = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+            tmp_filename = '%s.tmp' % self.filename
+            with open(tmp_filename, 'w') as outfile:
+                json.dump(data, outfile)
+            os.replace(tmp_filename, self.filename)
+
+#--------------------------------------------------------------------
+_tracer = None
+
+#--------------------------------------------------------------------
+def get_tracer():
+    return _tracer
+
+#--------------------------------------------------------------------
+def start_tracing(filename = None):
+    """
+        Start recording a trace to the given file, or only in memory
+        if 'filename' is None, unless a trace is already being recorded.
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(filename)
+    elif filename and _tracer.filename is None:
+        _tracer.filename = os.path.abspath(filename)
+    return _tracer
+
+#--------------------------------------------------------------------
+def trace_span(name, category, **args):
+    """
+        A context manager recording a span if tracing is enabled, or
+        doing nothing otherwise.  Yields a dict of args for the span.
+    """
+    if _tracer is None:
+        return contextlib.nullcontext(args)
+    return _tracer.span(name, category, **args)
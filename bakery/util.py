@@ -29,29 +29,35 @@ def degenerate(arg):
         return arg
 
 #--------------------------------------------------------------------
-def flat_map(arg, f = lambda x: x):
-    if isinstance(arg, (list, tuple)):
-        results = []
-        for x in arg:
-            results.extend(flat_map(x, f))
-        return results
-
-    elif isinstance(arg, dict):
-        return flat_map(list(arg.values()), f)
+def iter_flat(arg, f = lambda x: x):
+    """
+        Yields 'f(x)' for each item 'x' in the given structure of lists,
+        tuples and dict values, in order.  A stack of iterators is kept
+        rather than recursing, so that nothing is copied at each level
+        of nesting and deep structures don't exhaust the stack.
+    """
+    stack = [iter((arg,))]
+    while stack:
+        for x in stack[-1]:
+            if isinstance(x, (list, tuple)):
+                stack.append(iter(x))
+                break
+            elif isinstance(x, dict):
+                stack.append(iter(x.values()))
+                break
+            else:
+                yield f(x)
+        else:
+            stack.pop()
 
-    else:
-        return [f(arg)]
+#--------------------------------------------------------------------
+def flat_map(arg, f = lambda x: x):
+    return list(iter_flat(arg, f))
 
 #--------------------------------------------------------------------
 def wide_foreach(arg, f = lambda x: x):
-    if isinstance(arg, (list, tuple)):
-        for x in arg:
-            wide_foreach(x, f)
-    elif isinstance(arg, dict):
-        for x in arg.values():
-            wide_foreach(x, f)
-    else:
-        f(arg)
+    for _ in iter_flat(arg, f):
+        pass
 
 #--------------------------------------------------------------------
 def wide_map(arg, f = lambda x: x):
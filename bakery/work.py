@@ -5,9 +5,20 @@
 # Date: Tuesday, April 4 2017
 #--------------------------------------------------------------------
 
+import asyncio
+import collections
+import contextlib
 import functools
+import inspect
+import os
+import struct
 import subprocess
+import tempfile
 from .util import *
+from .engine import get_engine
+from .jobserver import get_jobserver
+from .log import LogWriter, capture_output, write_output
+from .trace import trace_span
 
 #--------------------------------------------------------------------
 class InterpolationError(BuildError):
@@ -21,6 +32,22 @@ class WorkflowError(BuildError):
 class CleanupError(BuildError):
     pass
 
+#--------------------------------------------------------------------
+# The operating system's limit in bytes on the combined size of the
+# arguments and environment of a new process, less some headroom as
+# POSIX recommends, and Linux's limit on the length of any single
+# argument (MAX_ARG_STRLEN, 32 pages).  See '_exceeds_arg_limits()'.
+try:
+    ARG_MAX = os.sysconf('SC_ARG_MAX') - 2048
+    MAX_ARG_STRLEN = 32 * os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    # Windows limits a command line to 32767 characters.
+    ARG_MAX = MAX_ARG_STRLEN = 32767
+
+#--------------------------------------------------------------------
+class BatchError(BuildError):
+    pass
+
 #--------------------------------------------------------------------
 class Actionable:
     @staticmethod
@@ -49,6 +76,17 @@ class Actionable:
     def result(self):
         return None
 
+#--------------------------------------------------------------------
+def run_task(task):
+    """
+        Runs the given Actionable from a TaskQueue, tracing the time
+        it takes if a trace is being recorded and writing the output
+        of its commands as a single block.
+    """
+    name = getattr(task, 'name', None) or task.__class__.__name__
+    with trace_span(name, 'task'), capture_output(name):
+        return task()
+
 #--------------------------------------------------------------------
 class Cleanable:
     @staticmethod
@@ -74,19 +112,13 @@ class Interpolatable:
 
     @staticmethod
     def interpolate(arg):
-        if isinstance(arg, Interpolatable):
-            return [Interpolatable.interpolate(x) for x in arg.interp()]
-        elif Interpolatable.is_raw(arg):
-            return [arg]
-        else:
-            raise InterpolationError("Cannot interpolate object of type '%s'." % (
-                arg.__class__))
+        return list(iter_command_line(arg))
 
     def interp(self):
         raise NotImplementedError()
 
     def __str__(self):
-        return ''.join(flat_map(Interpolatable.interpolate(self)))
+        return ''.join(iter_command_line(self))
 
 #--------------------------------------------------------------------
 class Task(Actionable):
@@ -116,7 +148,8 @@ class TaskQueue(Task, Cleanable, Interpolatable):
         return self.queue
 
     def run(self):
-        results = [task() for task in self.queue if not Actionable.is_complete(task)]
+        results = [task.result() if Actionable.is_complete(task) else run_task(task)
+                   for task in self.queue]
         self._result = results
         return results
 
@@ -141,21 +174,101 @@ class TaskQueue(Task, Cleanable, Interpolatable):
 
     def interp(self):
         if not self._result:
+            # A queue whose tasks were all complete is never evaluated.
+            if self.queue and self.is_done():
+                return [task.result() for task in self.queue]
             raise WorkflowError('Cannot interpolate TaskQueue until it has been evaluated.')
         return self._result
 
+#--------------------------------------------------------------------
+class TaskBatch(Task):
+    """
+        A group of tasks with the same 'batch_key()', which are run all
+        at once by the 'run_batch()' static method of their class.  It
+        returns the list of their results, or raises once every task in
+        the batch has been attempted if any of them failed.
+    """
+    def __init__(self, tasks):
+        super().__init__('%s (+%d)' % (tasks[0].name, len(tasks) - 1))
+        self.tasks = tasks
+
+    def run(self):
+        return type(self.tasks[0]).run_batch(self.tasks)
+
 #--------------------------------------------------------------------
 class ParallelTaskQueue(TaskQueue):
-    def __init__(self, name, process_pool, tasks = None):
+    """
+        A TaskQueue whose tasks are run concurrently on a worker pool.
+        Results are collected as tasks complete and kept in the order
+        of the queue.  When a task fails, the queue's tasks which have
+        not yet started are discarded and those still running are
+        terminated before the failure is raised.  Other queues running
+        at the same time are unaffected, see 'WorkerPool.run_unordered()'.
+
+        Tasks which provide a 'batch_key()' other than None are grouped
+        by key and split into one TaskBatch per worker, e.g. to compile
+        many sources with one compiler invocation.
+    """
+    def __init__(self, name, process_pool, tasks = None, chunksize = None):
         super().__init__(name, tasks = tasks)
         self.process_pool = process_pool
+        self.chunksize = chunksize
 
     def run(self):
-        results = self.process_pool.map(lambda x: x(),
-                [task for task in self.queue if not Actionable.is_complete(task)])
+        results = []
+        tasks = []
+        for n, task in enumerate(self.queue):
+            if Actionable.is_complete(task):
+                results.append(task.result())
+            else:
+                results.append(None)
+                tasks.append((n, task))
+        jobserver = get_jobserver()
+        try:
+            with jobserver.lend() if jobserver else contextlib.suppress():
+                for indices, result in self.process_pool.run_unordered(
+                        lambda x: (x[0], run_task(x[1])), self._batch(tasks), self.chunksize):
+                    if isinstance(indices, list):
+                        for n, batch_result in zip(indices, result):
+                            results[n] = batch_result
+                    else:
+                        results[indices] = result
+        finally:
+            # Tasks were run in other processes, discard anything this
+            # process has cached about the files they produced.
+            for n, task in tasks:
+                if has_method(task, 'invalidate'):
+                    task.invalidate()
+            # Write out what the tasks logged before anything after them.
+            LogWriter.get().flush()
         self._result = results
         return results
 
+    def _batch(self, tasks):
+        """
+            Returns the (n, task) pairs of tasks to run, with batchable
+            tasks replaced by ([n, ...], TaskBatch) pairs.
+        """
+        units = []
+        batches = collections.OrderedDict()
+        for n, task in tasks:
+            key = task.batch_key() if has_method(task, 'batch_key') else None
+            if key is None:
+                units.append((n, task))
+            else:
+                batches.setdefault(key, []).append((n, task))
+
+        workers = self.process_pool.size or os.cpu_count() or 1
+        for group in batches.values():
+            count = min(workers, len(group))
+            for i in range(count):
+                chunk = group[i * len(group) // count:(i + 1) * len(group) // count]
+                if len(chunk) == 1:
+                    units.append(chunk[0])
+                else:
+                    units.append(([n for n, task in chunk], TaskBatch([task for n, task in chunk])))
+        return units
+
 #--------------------------------------------------------------------
 class DeferredCallTask(Task):
     def __init__(self, f, *args, **kwargs):
@@ -175,21 +288,170 @@ def task(f):
     return task_encap_wrapper
 
 #--------------------------------------------------------------------
-def shell(*args, check = True):
+def iter_command_line(*args):
+    """
+        Yields the strings of the command line for the given arguments
+        in a single pass.  Lists, tuples, dict values and generators are
+        flattened, and Interpolatables are replaced by the results of
+        their 'interp()', which may themselves be nested, e.g. for a
+        TaskQueue of TaskQueues.
+    """
+    stack = [iter(args)]
+    while stack:
+        for x in stack[-1]:
+            if isinstance(x, (list, tuple)) or inspect.isgenerator(x):
+                stack.append(iter(x))
+                break
+            elif isinstance(x, dict):
+                stack.append(iter(x.values()))
+                break
+            elif isinstance(x, Interpolatable):
+                stack.append(iter(x.interp()))
+                break
+            elif Interpolatable.is_raw(x):
+                yield str(x)
+            else:
+                raise InterpolationError("Cannot interpolate object of type '%s'." % (
+                    x.__class__))
+        else:
+            stack.pop()
+
+#--------------------------------------------------------------------
+def command_line(*args):
+    """
+        Interpolates the given arguments into a flat list of strings
+        suitable for use as a subprocess command line.
+    """
+    return list(iter_command_line(*args))
+
+#--------------------------------------------------------------------
+def _quote_response_arg(arg):
+    return ''.join('\\' + c if c.isspace() or c in '\\\'"' else c for c in arg)
+
+#--------------------------------------------------------------------
+def _exceeds_arg_limits(cmd_line, env = None):
+    """
+        Determines if running the given command line with the given
+        environment, by default this process' environment, would
+        exceed ARG_MAX or MAX_ARG_STRLEN.  Each argument and variable
+        also costs a pointer in the new process' argv or envp.
+    """
+    if env is None:
+        env = os.environ
+    pointer_size = struct.calcsize('P')
+    args = [os.fsencode(arg) for arg in cmd_line]
+    if any(len(arg) >= MAX_ARG_STRLEN for arg in args):
+        return True
+    size = sum(len(arg) + 1 + pointer_size for arg in args)
+    size += sum(len(os.fsencode(k)) + len(os.fsencode(v)) + 2 + pointer_size for k, v in env.items())
+    return size > ARG_MAX
+
+#--------------------------------------------------------------------
+@contextlib.contextmanager
+def _response_file(cmd_line, enabled, env = None):
+    """
+        Yields the command line to run in place of the given one.  If
+        'enabled' and it would exceed the operating system's limits,
+        its arguments are written to a temporary response file which
+        is passed to the command as '@file'.  Only enable this for
+        commands which understand response files, e.g. GCC, Clang, ld
+        and ar.
+    """
+    if not enabled or not _exceeds_arg_limits(cmd_line, env):
+        yield cmd_line
+        return
+    with tempfile.NamedTemporaryFile('w', prefix = 'bakery-', suffix = '.rsp', delete = False) as outfile:
+        for arg in cmd_line[1:]:
+            outfile.write(_quote_response_arg(arg) + '\n')
+    try:
+        yield [cmd_line[0], '@' + outfile.name]
+    finally:
+        os.remove(outfile.name)
+
+#--------------------------------------------------------------------
+def _write_output(result):
+    write_output((result.stdout or b'').decode('utf-8', 'replace'),
+                 (result.stderr or b'').decode('utf-8', 'replace'))
+
+#--------------------------------------------------------------------
+def _run_command(cmd_line, cwd = None, response_file = False):
+    """
+        Runs the given command line on the shell engine, holding a
+        jobserver token while it runs so that child processes of
+        this build and of any enclosing or nested make share a single
+        set of job slots.
+    """
+    jobserver = get_jobserver()
+    env = jobserver.environment() if jobserver is not None else None
+    with trace_span(os.path.basename(cmd_line[0]), 'shell', command = ' '.join(cmd_line)), \
+            _response_file(cmd_line, response_file, env) as argv:
+        if jobserver is None:
+            return get_engine().run(argv, cwd = cwd)
+        with jobserver.slot():
+            return get_engine().run(argv, cwd = cwd, env = env, pass_fds = jobserver.pass_fds())
+
+#--------------------------------------------------------------------
+def shell(*args, check = True, cwd = None, response_file = False):
+    """
+        Executes the given command on the shell engine, blocking until
+        it completes.  The command's output is captured and written
+        out in one piece once it completes.  Raises
+        subprocess.CalledProcessError if the command fails and 'check'
+        is True, otherwise returns its return code.  The command is run
+        in 'cwd' if given.  If 'response_file' is True, command lines
+        too long for the operating system are passed to the command in
+        a response file, see '_response_file()'.
+    """
     log = logger_for_function(shell)
-    cmd_line = compose(args,
-        lambda x: flat_map(x, degenerate),
-        lambda x: flat_map(x, Interpolatable.interpolate),
-        lambda x: flat_map(x, lambda x: str(x)))
+    cmd_line = command_line(*args)
     log.info("Executing command: %s" % " ".join(cmd_line))
 
-    try:
-        subprocess.check_call(cmd_line)
-        return 0
+    result = _run_command(cmd_line, cwd = cwd, response_file = response_file)
+    _write_output(result)
+    if result.returncode != 0 and check:
+        raise subprocess.CalledProcessError(result.returncode, cmd_line, result.stdout, result.stderr)
+    return result.returncode
 
-    except Exception as e:
-        if check:
-            raise e
+#--------------------------------------------------------------------
+async def shell_async(*args, check = True, response_file = False):
+    """
+        A coroutine version of 'shell()' for use from asyncio code
+        running on any event loop.
+    """
+    log = logger_for_function(shell_async)
+    cmd_line = command_line(*args)
+    log.info("Executing command: %s" % " ".join(cmd_line))
+
+    jobserver = get_jobserver()
+    env = jobserver.environment() if jobserver is not None else None
+    with trace_span(os.path.basename(cmd_line[0]), 'shell', command = ' '.join(cmd_line)), \
+            _response_file(cmd_line, response_file, env) as argv:
+        if jobserver is None:
+            result = await asyncio.wrap_future(get_engine().submit(argv))
         else:
-            return e.returncode
+            token = await asyncio.get_event_loop().run_in_executor(None, jobserver.acquire)
+            try:
+                result = await asyncio.wrap_future(get_engine().submit(argv,
+                    env = env, pass_fds = jobserver.pass_fds()))
+            finally:
+                jobserver.release(token)
+    _write_output(result)
+    if result.returncode != 0 and check:
+        raise subprocess.CalledProcessError(result.returncode, cmd_line, result.stdout, result.stderr)
+    return result.returncode
+
+#--------------------------------------------------------------------
+def shell_output(*args, response_file = False):
+    """
+        Executes the given command as per 'shell()', returning
+        its standard output as bytes.
+    """
+    log = logger_for_function(shell_output)
+    cmd_line = command_line(*args)
+    log.info("Executing command: %s" % " ".join(cmd_line))
 
+    result = _run_command(cmd_line, response_file = response_file)
+    if result.returncode != 0:
+        _write_output(result._replace(stdout = None))
+        raise subprocess.CalledProcessError(result.returncode, cmd_line, result.stdout, result.stderr)
+    return result.stdout
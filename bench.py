@@ -0,0 +1,461 @@
+#--------------------------------------------------------------------
+# bench.py: Benchmarks for the Bakery build system.
+#
+# Author: Lain Supe (supelee)
+# Date: Friday, October 16th 2026
+#--------------------------------------------------------------------
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bakery.core import BuildTaskDecider
+from bakery.evaluate import TaskEvaluator
+from bakery.work import Task
+
+#--------------------------------------------------------------------
+class StubAttributes:
+    def __init__(self, tags):
+        self.tags = tags
+
+    def check(self, tag):
+        return tag in self.tags
+
+#--------------------------------------------------------------------
+class StubTask(Task):
+    def __init__(self, name, done = False):
+        super().__init__(name)
+        self.done = done
+
+    def is_done(self):
+        return self.done
+
+    def run(self):
+        self.done = True
+        return self.name
+
+#--------------------------------------------------------------------
+class GraphInjector:
+    """
+        A minimal stand-in for a xeno.Injector that resolves every
+        resource in a plain dependency graph to a StubTask, so that
+        evaluation can be measured without constructing build modules.
+    """
+    def __init__(self, graph, done = ()):
+        self.graph = graph
+        self.done = set(done)
+        self.resources = {}
+
+    def get_dependencies(self, target):
+        return self.graph[target]
+
+    def get_dependency_graph(self, *targets):
+        dep_graph = {}
+        todo = collections.deque(targets)
+        while todo:
+            target = todo.popleft()
+            if target not in dep_graph:
+                dep_graph[target] = self.graph[target]
+                todo.extend(self.graph[target])
+        return dep_graph
+
+    def get_resource_attributes(self, target):
+        return StubAttributes({'singleton'})
+
+    def require(self, target):
+        if target not in self.resources:
+            self.resources[target] = StubTask(target, target in self.done)
+        return self.resources[target]
+
+    def unbind_singleton(self, target):
+        pass
+
+    def provide(self, target, value, is_singleton = False):
+        self.resources[target] = value
+
+#--------------------------------------------------------------------
+def diamond_chain(depth):
+    """
+        Generates a chain of 'depth' diamonds, where every target
+        depends on two targets which both depend on the next one.
+        The number of distinct paths doubles with every diamond.
+    """
+    graph = {'n%d' % depth: []}
+    for n in range(depth):
+        graph['n%d' % n] = ['l%d' % n, 'r%d' % n]
+        graph['l%d' % n] = ['n%d' % (n + 1)]
+        graph['r%d' % n] = ['n%d' % (n + 1)]
+    return graph
+
+#--------------------------------------------------------------------
+def chain_graph(size):
+    """ A single chain of 'size' targets, each depending on the next. """
+    graph = {'n%d' % n: ['n%d' % (n + 1)] for n in range(size - 1)}
+    graph['n%d' % (size - 1)] = []
+    return graph
+
+#--------------------------------------------------------------------
+def fanout_graph(size):
+    """ A single target depending directly on 'size - 1' leaves. """
+    graph = {'n%d' % n: [] for n in range(1, size)}
+    graph['n0'] = ['n%d' % n for n in range(1, size)]
+    return graph
+
+#--------------------------------------------------------------------
+def diamond_graph(size):
+    """ A chain of diamonds with roughly 'size' targets. """
+    return diamond_chain(max(1, (size - 1) // 3))
+
+#--------------------------------------------------------------------
+# Generators of synthetic dependency graphs with the given number of
+# targets, all rooted at 'n0'.
+SHAPES = collections.OrderedDict([
+    ('chain', chain_graph),
+    ('fanout', fanout_graph),
+    ('diamond', diamond_graph)
+])
+
+#--------------------------------------------------------------------
+def timed(f, repeat):
+    best = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+#--------------------------------------------------------------------
+def peak_memory(f):
+    """
+        Returns the peak memory in KiB allocated by Python while
+        running 'f', measured in a separate run as tracing allocations
+        slows it down.
+    """
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+#--------------------------------------------------------------------
+def measure(benchmark, shape, size, f, repeat):
+    """
+        Returns the result of running 'f' as a benchmark: its best
+        time over 'repeat' runs and its peak memory.
+    """
+    return {'benchmark': benchmark, 'shape': shape, 'size': size,
+            'seconds': timed(f, repeat), 'peak_kb': peak_memory(f)}
+
+#--------------------------------------------------------------------
+def bench_graphs(benchmark, sizes, repeat, make_run, shapes = SHAPES):
+    """
+        Runs 'make_run(graph)' as a benchmark for every shape of graph
+        and size, yielding the results.
+    """
+    for shape, generate in shapes.items():
+        for size in sizes:
+            graph = generate(size)
+            yield measure(benchmark, shape, len(graph), make_run(graph), repeat)
+
+#--------------------------------------------------------------------
+def bench_evaluation_set(sizes, repeat):
+    """
+        Measures the cost of computing the evaluation set of every
+        shape of graph, from an already resolved dependency graph.
+    """
+    def make_run(graph):
+        dep_graph = GraphInjector(graph).get_dependency_graph('n0')
+        return lambda: BuildTaskDecider().get_evaluation_set(GraphInjector(graph), ['n0'], dep_graph)
+    return bench_graphs('evaluation-set', sizes, repeat, make_run)
+
+#--------------------------------------------------------------------
+def bench_schedule(sizes, repeat):
+    """
+        Measures the cost of resolving, scheduling and evaluating every
+        target of every shape of graph with stub tasks.
+    """
+    def make_run(graph):
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                TaskEvaluator(BuildTaskDecider()).evaluate(GraphInjector(graph), ['n0'])
+        return run
+    return bench_graphs('schedule', sizes, repeat, make_run)
+
+#--------------------------------------------------------------------
+def build_module_source(graph):
+    """
+        Generates the source of a build module class providing every
+        target of the given graph, with its dependencies as parameters.
+    """
+    lines = ['class SyntheticBuild:']
+    for target, deps in graph.items():
+        lines.append('    @provide')
+        lines.append('    def %s(self%s):' % (target, ''.join(', ' + dep for dep in deps)))
+        lines.append('        return %r' % target)
+    return '\n'.join(lines) + '\n'
+
+#--------------------------------------------------------------------
+def bench_injector(sizes, repeat):
+    """
+        Measures the cost of constructing a xeno.Injector for a build
+        module with a resource per target, and of resolving its
+        dependency graph.  Only the fan-out shape is measured, as
+        xeno's cycle check walks every path recursively, overflowing
+        the stack on long chains and taking exponential time on chains
+        of diamonds.
+    """
+    import xeno
+    def make_run(graph):
+        scope = {'provide': xeno.provide}
+        exec(build_module_source(graph), scope)
+        module = scope['SyntheticBuild']
+        return lambda: xeno.Injector(module()).get_dependency_graph('n0')
+    return bench_graphs('injector', sizes, repeat, make_run, {'fanout': fanout_graph})
+
+#--------------------------------------------------------------------
+# A stand-in for a C compiler and linker, creating empty outputs and
+# dependency files so that builds need no toolchain.
+STUB_COMPILER = """#!/bin/sh
+out=; dep=
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o) out=$2; shift ;;
+        -MF) dep=$2; shift ;;
+    esac
+    shift
+done
+[ -n "$dep" ] && echo "$out: " > "$dep"
+: > "$out"
+"""
+
+#--------------------------------------------------------------------
+# The largest project populated on disk by the benchmarks running
+# 'bake', as populating larger ones dominates the run time.
+MAX_PROJECT_FILES = 2000
+
+#--------------------------------------------------------------------
+def bake_env():
+    return dict(os.environ, PYTHONPATH = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH', '')]))
+
+#--------------------------------------------------------------------
+def run_bake(root, *args):
+    """
+        Runs 'bake' in the given directory, returning the peak resident
+        memory of the process in KiB.
+    """
+    proc = subprocess.Popen([sys.executable, '-m', 'bakery.bake', *args], cwd = root, env = bake_env(),
+                            stdout = subprocess.DEVNULL)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return usage.ru_maxrss
+
+#--------------------------------------------------------------------
+def measure_bake(benchmark, shape, size, root, args, repeat):
+    return {'benchmark': benchmark, 'shape': shape, 'size': size,
+            'seconds': timed(lambda: run_bake(root, *args), repeat),
+            'peak_kb': run_bake(root, *args)}
+
+#--------------------------------------------------------------------
+PARALLEL_BAKEFILE = """
+from bakery.recipe import c
+
+@build
+class ParallelBench:
+    @provide
+    def builder(self):
+        config = c.Config()
+        config.CC = './stubcc'
+        return c.Builder(config)
+
+    @provide
+    def sources(self):
+        return File.glob('src/*.c')
+
+    @output
+    @parallel
+    def objects(self, builder, sources):
+        return [builder.compile(src) for src in sources]
+
+    @output
+    @default
+    def program(self, builder, objects):
+        return builder.link(objects, 'program')
+"""
+
+#--------------------------------------------------------------------
+def bench_parallel(sizes, repeat):
+    """
+        Measures full and no-op builds of a C project with a large
+        @parallel queue of sources, compiled by a stub compiler.
+    """
+    for size in [size for size in sizes if size <= MAX_PROJECT_FILES]:
+        with tempfile.TemporaryDirectory(prefix = 'bakery-bench-') as root:
+            os.makedirs(os.path.join(root, 'src'))
+            for n in range(size):
+                with open(os.path.join(root, 'src', 'f%d.c' % n), 'w') as outfile:
+                    outfile.write('int f%d(void) { return %d; }\n' % (n, n))
+            with open(os.path.join(root, 'stubcc'), 'w') as outfile:
+                outfile.write(STUB_COMPILER)
+            os.chmod(os.path.join(root, 'stubcc'), 0o755)
+            with open(os.path.join(root, 'Bakefile.py'), 'w') as outfile:
+                outfile.write(PARALLEL_BAKEFILE)
+
+            def clean_build():
+                run_bake(root, '-c')
+                return run_bake(root)
+            yield {'benchmark': 'parallel', 'shape': 'full', 'size': size,
+                   'seconds': timed(clean_build, repeat), 'peak_kb': clean_build()}
+            yield measure_bake('parallel', 'noop', size, root, ['--no-fast-path'], repeat)
+
+#--------------------------------------------------------------------
+NOOP_BAKEFILE = """
+import shutil
+
+class Copy(FileTask):
+    def __init__(self, src):
+        super().__init__(File.change_ext(src, 'out'))
+        self.src = src
+
+    def inputs(self):
+        return [self.src]
+
+    def run(self):
+        shutil.copy(self.src.abspath(), self.file.abspath())
+        return self.file
+
+@build
+class NoopBench:
+    @provide
+    def sources(self):
+        return File.glob('src/*.txt')
+
+    @output
+    @default
+    @queue
+    def outputs(self, sources):
+        return [Copy(src) for src in sources]
+"""
+
+#--------------------------------------------------------------------
+def bench_noop(sizes, repeat):
+    """
+        Measures the latency of running 'bake' on an up to date project
+        of the given numbers of files, with and without the no-op fast
+        path.
+    """
+    for size in [size for size in sizes if size <= MAX_PROJECT_FILES]:
+        with tempfile.TemporaryDirectory(prefix = 'bakery-bench-') as root:
+            os.makedirs(os.path.join(root, 'src'))
+            for n in range(size):
+                with open(os.path.join(root, 'src', 'f%d.txt' % n), 'w') as outfile:
+                    outfile.write(str(n))
+            with open(os.path.join(root, 'Bakefile.py'), 'w') as outfile:
+                outfile.write(NOOP_BAKEFILE)
+
+            # Build, then record the no-op manifest.
+            run_bake(root)
+            run_bake(root)
+            yield measure_bake('noop', 'fast-path', size, root, [], repeat)
+            yield measure_bake('noop', 'full', size, root, ['--no-fast-path'], repeat)
+
+#--------------------------------------------------------------------
+BENCHMARKS = collections.OrderedDict([
+    ('evaluation-set', bench_evaluation_set),
+    ('schedule', bench_schedule),
+    ('injector', bench_injector),
+    ('parallel', bench_parallel),
+    ('noop', bench_noop)
+])
+
+RESULT_FORMAT = '%-16s %-10s %10s %12s %14s %12s'
+
+#--------------------------------------------------------------------
+def result_key(result):
+    return (result['benchmark'], result['shape'], result['size'])
+
+#--------------------------------------------------------------------
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#--------------------------------------------------------------------
+def compare(results, baseline, threshold):
+    """
+        Prints the ratio of each result to the matching result of a
+        baseline run, returning the results which are slower than the
+        baseline by more than 'threshold'.
+    """
+    baseline = {result_key(result): result for result in baseline['results']}
+    regressions = []
+    print(RESULT_FORMAT % ('benchmark', 'shape', 'size', 'seconds', 'time ratio', 'mem ratio'))
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        time_ratio = result['seconds'] / base['seconds'] if base['seconds'] else 1.0
+        mem_ratio = result['peak_kb'] / base['peak_kb'] if base['peak_kb'] else 1.0
+        flag = ' <-- regression' if time_ratio > threshold else ''
+        print((RESULT_FORMAT + '%s') % (result['benchmark'], result['shape'], result['size'],
+                                        '%.4f' % result['seconds'], '%.2f' % time_ratio, '%.2f' % mem_ratio, flag))
+        if time_ratio > threshold:
+            regressions.append(result)
+    return regressions
+
+#--------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description = 'Run Bakery benchmarks.')
+    parser.add_argument('benchmarks', metavar='BENCHMARK', nargs='*', default=list(BENCHMARKS.keys()))
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Numbers of targets, or of files for benchmarks running bake.')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--save', metavar='FILE', help='Save the results as JSON.')
+    parser.add_argument('-c', '--compare', metavar='FILE', help='Compare against results saved with --save.')
+    parser.add_argument('-t', '--threshold', type=float, default=1.10,
+                        help='Time ratio above which a result counts as a regression.')
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            print('Unknown benchmark: %s' % name)
+            sys.exit(1)
+
+    results = []
+    print(RESULT_FORMAT % ('benchmark', 'shape', 'size', 'seconds', 'usec/item', 'peak KiB'))
+    for name in args.benchmarks:
+        for result in BENCHMARKS[name](args.sizes, args.repeat):
+            print(RESULT_FORMAT % (result['benchmark'], result['shape'], result['size'], '%.4f' % result['seconds'],
+                                   '%.2f' % (1e6 * result['seconds'] / result['size']), result['peak_kb']))
+            sys.stdout.flush()
+            results.append(result)
+
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump({'revision': revision(), 'python': sys.version, 'results': results}, outfile, indent = 2)
+
+    if args.compare:
+        with open(args.compare, 'r') as infile:
+            baseline = json.load(infile)
+        print()
+        print('Compared with %s' % (baseline.get('revision') or args.compare))
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+#--------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
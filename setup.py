@@ -30,7 +30,8 @@ setup(
 
     entry_points={
         'console_scripts': [
-            'bake=bakery.bake:main'
+            'bake=bakery.bake:main',
+            'bake-worker=bakery.remote:worker_main'
         ],
     }
 )
@@ -1,5 +1,24 @@
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from bakery import *
+from bakery.cache import ObjectCache, SharedCache
+from bakery.db import BuildDatabase
+from bakery.file import File, FileTask, parse_depfile
+from bakery.fscache import StatCache, stat_cache
+from bakery.jobserver import IMPLICIT_TOKEN, TOKEN, Jobserver
+from bakery.parallel import WorkerPool
+from bakery.recipe import cpp
+from bakery.remote import RemoteError, RemoteExecutor
+from bakery import work
+from bakery.work import InterpolationError, ParallelTaskQueue, iter_command_line, shell_output, task
 
 #--------------------------------------------------------------------
 def create_test_graph():
@@ -27,8 +46,648 @@ def create_test_graph():
         'J':        [],
         'K':        ['D'],
         'L':        ['F'],
-        'M':        ['C']
+        'M':        ['E']
     }
 
 #--------------------------------------------------------------------
 class EvaluateTests(unittest.TestCase):
+    def evaluate_in_order(self, graph, eval_set):
+        schedule = EvaluationSchedule(graph, eval_set)
+        ready = list(schedule.start())
+        order = []
+        while ready:
+            target = ready.pop(0)
+            order.append(target)
+            ready.extend(schedule.complete(target))
+        self.assertTrue(schedule.is_finished())
+        return order
+
+    def test_schedule_respects_dependencies(self):
+        graph = create_test_graph()
+        order = self.evaluate_in_order(graph, set(graph))
+        self.assertEqual(set(order), set(graph))
+        for target, deps in graph.items():
+            for dep in deps:
+                self.assertLess(order.index(dep), order.index(target))
+
+    def test_schedule_passes_through_skipped_targets(self):
+        graph = create_test_graph()
+        order = self.evaluate_in_order(graph, {'A', 'E', 'H'})
+        self.assertEqual(order, ['H', 'E', 'A'])
+
+    def test_schedule_dispatches_without_level_barrier(self):
+        schedule = EvaluationSchedule(create_test_graph(), set(create_test_graph()))
+        self.assertEqual(set(schedule.start()), {'G', 'H', 'I', 'J'})
+        self.assertEqual(schedule.complete('G'), ['D'])
+        self.assertEqual(set(schedule.complete('D')), {'K'})
+
+#--------------------------------------------------------------------
+class CommandLineTests(unittest.TestCase):
+    def setUp(self):
+        self.saved_arg_max = work.ARG_MAX
+
+    def tearDown(self):
+        work.ARG_MAX = self.saved_arg_max
+
+    def test_iter_command_line_flattens_arguments(self):
+        args = ['cc', ('-O2', ['-g', [1, 2.5]]), {'x': '-c'}, (name for name in ['a.c', 'b.c']),
+                File('out.o')]
+        self.assertEqual(list(iter_command_line(*args)),
+                         ['cc', '-O2', '-g', '1', '2.5', '-c', 'a.c', 'b.c', File('out.o').abspath()])
+
+    def test_iter_command_line_rejects_other_objects(self):
+        with self.assertRaises(InterpolationError):
+            list(iter_command_line('cc', [object()]))
+
+    def test_quote_response_arg_round_trips(self):
+        for arg in ['plain', 'with space', 'tab\there', 'a"quote', "it's", 'back\\slash', '']:
+            self.assertEqual(shlex.split(work._quote_response_arg(arg)) or [''], [arg])
+
+    def test_arg_limits(self):
+        self.assertFalse(work._exceeds_arg_limits(['cc', '-c', 'a.c']))
+        self.assertTrue(work._exceeds_arg_limits(['cc', 'x' * work.MAX_ARG_STRLEN]))
+        self.assertTrue(work._exceeds_arg_limits(['cc'], {'BIG': 'x' * work.ARG_MAX}))
+
+    def test_response_files_are_opt_in(self):
+        work.ARG_MAX = 0
+        self.assertEqual(shell_output('echo', 'a b', '@c'), b'a b @c\n')
+
+    @unittest.skipUnless(shutil.which('gcc'), 'gcc is not installed.')
+    def test_response_file_passes_quoted_arguments(self):
+        work.ARG_MAX = 0
+        output = shell_output('gcc', '-DMSG="a b\\ \'c\'"', '-E', '-dM', '-x', 'c', os.devnull,
+                              response_file = True)
+        self.assertIn(b'#define MSG "a b\\ \'c\'"', output.splitlines())
+
+#--------------------------------------------------------------------
+class DepfileTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def parse(self, text):
+        filename = os.path.join(self.dir, 'a.d')
+        with open(filename, 'w') as outfile:
+            outfile.write(text)
+        return [f.abspath() for f in parse_depfile(filename)]
+
+    def test_missing_depfile(self):
+        self.assertEqual(parse_depfile(os.path.join(self.dir, 'missing.d')), [])
+
+    def test_escaped_spaces_and_hashes(self):
+        self.assertEqual(self.parse('a.o: /src/my\\ file.c /inc/\\#x.h\n'),
+                         ['/src/my file.c', '/inc/#x.h'])
+
+    def test_escaped_dollars(self):
+        self.assertEqual(self.parse('a.o: /src/$$HOME.c /inc/a$$$$b.h\n'),
+                         ['/src/$HOME.c', '/inc/a$$b.h'])
+
+    def test_line_continuations(self):
+        self.assertEqual(self.parse('a.o: /src/a.c \\\n  /inc/a.h \\\n  /inc/b.h\n'),
+                         ['/src/a.c', '/inc/a.h', '/inc/b.h'])
+
+    def test_multiple_rules(self):
+        # As written with '-MP', which adds an empty rule for each header.
+        self.assertEqual(self.parse('a.o a.d: /src/a.c /inc/a.h\n\n/inc/a.h:\nb.o: /src/b.c\n'),
+                         ['/src/a.c', '/inc/a.h', '/src/b.c'])
+
+#--------------------------------------------------------------------
+class JobserverTests(unittest.TestCase):
+    def setUp(self):
+        self.jobservers = []
+
+    def tearDown(self):
+        for jobserver in self.jobservers:
+            jobserver.close()
+
+    def create(self, jobs, style = 'pipe'):
+        jobserver = Jobserver.create(jobs, style)
+        self.jobservers.append(jobserver)
+        return jobserver
+
+    def available(self, jobserver):
+        """
+            Returns the number of tokens waiting in the jobserver,
+            leaving them in place.
+        """
+        os.set_blocking(jobserver.read_fd, False)
+        try:
+            tokens = os.read(jobserver.read_fd, 1024)
+        except BlockingIOError:
+            tokens = b''
+        finally:
+            os.set_blocking(jobserver.read_fd, True)
+        if tokens:
+            os.write(jobserver.write_fd, tokens)
+        return len(tokens)
+
+    def test_token_accounting(self):
+        jobserver = self.create(3)
+        self.assertEqual(self.available(jobserver), 2)
+        tokens = [jobserver.acquire() for n in range(3)]
+        self.assertEqual(tokens, [IMPLICIT_TOKEN, TOKEN, TOKEN])
+        self.assertEqual((jobserver.held, self.available(jobserver)), (2, 0))
+        for token in tokens:
+            jobserver.release(token)
+        self.assertEqual((jobserver.held, self.available(jobserver)), (0, 2))
+        self.assertTrue(jobserver.implicit_free)
+
+    def test_lend_implicit_token(self):
+        jobserver = self.create(1)
+        self.assertEqual(self.available(jobserver), 0)
+        with jobserver.lend():
+            self.assertEqual(self.available(jobserver), 1)
+            self.assertFalse(jobserver.implicit_free)
+        self.assertEqual((jobserver.held, self.available(jobserver)), (0, 0))
+        self.assertTrue(jobserver.implicit_free)
+
+    def test_lend_without_free_implicit_token(self):
+        jobserver = self.create(1)
+        token = jobserver.acquire()
+        with jobserver.lend():
+            self.assertEqual(self.available(jobserver), 0)
+        jobserver.release(token)
+        self.assertTrue(jobserver.implicit_free)
+
+    def test_tokens_returned_on_failure(self):
+        jobserver = self.create(2)
+        with self.assertRaises(ValueError):
+            with jobserver.slot(), jobserver.slot():
+                self.assertEqual(self.available(jobserver), 0)
+                raise ValueError('Job failed.')
+        self.assertEqual((jobserver.held, self.available(jobserver)), (0, 1))
+        self.assertTrue(jobserver.implicit_free)
+
+    def test_release_all(self):
+        jobserver = self.create(3)
+        jobserver.acquire()
+        jobserver.acquire()
+        jobserver.acquire()
+        jobserver.release_all()
+        self.assertEqual((jobserver.held, self.available(jobserver)), (0, 2))
+
+    def test_pipe_makeflags(self):
+        jobserver = self.create(2)
+        self.assertIn('-j2', jobserver.makeflags.split())
+        client = Jobserver.from_makeflags(jobserver.makeflags)
+        self.assertEqual((client.read_fd, client.write_fd), (jobserver.read_fd, jobserver.write_fd))
+        legacy = Jobserver.from_makeflags('-j2 --jobserver-fds=%d,%d' % (jobserver.read_fd, jobserver.write_fd))
+        self.assertEqual((legacy.read_fd, legacy.write_fd), (jobserver.read_fd, jobserver.write_fd))
+        self.assertEqual(jobserver.pass_fds(), tuple(sorted({jobserver.read_fd, jobserver.write_fd})))
+
+    def test_fifo_makeflags(self):
+        jobserver = self.create(2, 'fifo')
+        self.assertEqual(jobserver.pass_fds(), ())
+        client = Jobserver.from_makeflags(jobserver.makeflags)
+        try:
+            self.assertEqual(client.acquire(), IMPLICIT_TOKEN)
+            self.assertEqual(client.acquire(), TOKEN)
+            self.assertEqual(self.available(jobserver), 0)
+            client.release(TOKEN)
+            self.assertEqual(self.available(jobserver), 1)
+        finally:
+            os.close(client.read_fd)
+
+    def test_unusable_makeflags(self):
+        read_fd, write_fd = os.pipe()
+        os.close(read_fd)
+        os.close(write_fd)
+        for makeflags in (None, '', '-j4', '--jobserver-auth=%d,%d' % (read_fd, write_fd),
+                          '--jobserver-auth=bogus', '--jobserver-auth=fifo:/nonexistent/fifo'):
+            self.assertIsNone(Jobserver.from_makeflags(makeflags), makeflags)
+
+#--------------------------------------------------------------------
+class StatCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'a.c')
+        self.cache = StatCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        with open(self.path, 'w') as outfile:
+            outfile.write(text)
+
+    def test_stat_is_cached_until_invalidated(self):
+        self.assertFalse(self.cache.exists(self.path))
+        self.write('a')
+        self.assertFalse(self.cache.exists(self.path))
+        self.cache.invalidate(self.path)
+        self.assertEqual(self.cache.stat(self.path).st_size, 1)
+        self.write('ab')
+        self.assertEqual(self.cache.stat(self.path).st_size, 1)
+        self.cache.invalidate(self.path)
+        self.assertEqual(self.cache.stat(self.path).st_size, 2)
+
+    def test_clear_discards_every_entry(self):
+        self.write('a')
+        self.assertTrue(self.cache.exists(self.path))
+        self.assertTrue(self.cache.is_dir(self.dir))
+        os.remove(self.path)
+        self.assertTrue(self.cache.exists(self.path))
+        self.cache.clear()
+        self.assertFalse(self.cache.exists(self.path))
+        self.assertTrue(self.cache.is_dir(self.dir))
+
+#--------------------------------------------------------------------
+class ConcatTask(FileTask):
+    """
+        Writes the contents of its inputs, one after the other, to its
+        file.  Used to stand in for compiling and linking.
+    """
+    def __init__(self, output, sources):
+        super().__init__(File(output))
+        self.sources = sources
+
+    def inputs(self):
+        return [source.file if isinstance(source, FileTask) else File(source)
+                for source in self.sources]
+
+    def run(self):
+        with open(self.file.abspath(), 'w') as outfile:
+            for f in self.inputs():
+                with open(f.abspath(), 'r') as infile:
+                    outfile.write(infile.read())
+        return self.file
+
+#--------------------------------------------------------------------
+class FailingTask(ConcatTask):
+    def run(self):
+        with open(self.file.abspath(), 'w') as outfile:
+            outfile.write('partial')
+        raise ValueError('Task failed.')
+
+#--------------------------------------------------------------------
+class BuildDatabaseTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved_instance = BuildDatabase._instance
+        BuildDatabase._instance = BuildDatabase(self.path('.bakery', 'db'))
+        stat_cache.clear()
+
+    def tearDown(self):
+        BuildDatabase._instance = self.saved_instance
+        stat_cache.clear()
+        shutil.rmtree(self.dir)
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def write(self, name, text):
+        with open(self.path(name), 'w') as outfile:
+            outfile.write(text)
+        stat_cache.clear()
+
+    def build(self, tasks):
+        """
+            Checks every task before running any of them, as the build
+            does, then runs those which are out of date in order.
+            Returns the names of the files which were rebuilt.
+        """
+        stat_cache.clear()
+        todo = [task for task in tasks if not task.is_done()]
+        try:
+            for task in todo:
+                task()
+        finally:
+            BuildDatabase.get().commit()
+        return [os.path.basename(task.file.abspath()) for task in todo]
+
+    def create_tasks(self):
+        for name in ('a.c', 'b.c'):
+            if not os.path.exists(self.path(name)):
+                self.write(name, name[0])
+        a = ConcatTask(self.path('a.o'), [self.path('a.c')])
+        b = ConcatTask(self.path('b.o'), [self.path('b.c')])
+        return [a, b, ConcatTask(self.path('prog'), [a, b])]
+
+    def test_first_build_runs_everything(self):
+        self.assertEqual(self.build(self.create_tasks()), ['a.o', 'b.o', 'prog'])
+        self.assertEqual(self.build(self.create_tasks()), [])
+
+    def test_edit_rebuilds_object_and_relinks(self):
+        self.build(self.create_tasks())
+        self.write('a.c', 'edited')
+        self.assertEqual(self.build(self.create_tasks()), ['a.o', 'prog'])
+        with open(self.path('prog')) as infile:
+            self.assertEqual(infile.read(), 'editedb')
+
+    def test_touch_does_not_rebuild(self):
+        self.build(self.create_tasks())
+        st = os.stat(self.path('a.c'))
+        os.utime(self.path('a.c'), ns = (st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.build(self.create_tasks()), [])
+
+    def test_deleted_output_is_rebuilt(self):
+        self.build(self.create_tasks())
+        os.remove(self.path('prog'))
+        self.assertEqual(self.build(self.create_tasks()), ['prog'])
+
+    def test_failed_task_is_not_recorded(self):
+        self.write('a.c', 'a')
+        failing = FailingTask(self.path('a.o'), [self.path('a.c')])
+        with self.assertRaises(ValueError):
+            self.build([failing])
+        self.assertNotIn(self.path('a.o'), BuildDatabase.get().records)
+        self.assertEqual(self.build([ConcatTask(self.path('a.o'), [self.path('a.c')])]), ['a.o'])
+
+#--------------------------------------------------------------------
+@task
+def sleep_and_return(n):
+    time.sleep(0.3)
+    return n
+
+#--------------------------------------------------------------------
+@task
+def sleep_and_fail():
+    time.sleep(0.1)
+    raise ValueError('Task failed.')
+
+#--------------------------------------------------------------------
+running = {'now': 0, 'most': 0}
+running_lock = threading.Lock()
+
+#--------------------------------------------------------------------
+@task
+def sleep_and_count():
+    with running_lock:
+        running['now'] += 1
+        running['most'] = max(running['most'], running['now'])
+    time.sleep(0.1)
+    with running_lock:
+        running['now'] -= 1
+
+#--------------------------------------------------------------------
+@task
+def complete_in_database(filename):
+    BuildDatabase.get().complete(ConcatTask(filename, []))
+    return True
+
+#--------------------------------------------------------------------
+class ParallelTests(unittest.TestCase):
+    def run_concurrent_queues(self, backend):
+        pool = WorkerPool(4, backend)
+        failing = ParallelTaskQueue('failing', pool, [sleep_and_fail()])
+        passing = ParallelTaskQueue('passing', pool, [sleep_and_return(n) for n in range(8)])
+        outcomes = {}
+        def run(queue):
+            try:
+                outcomes[queue.name] = queue.run()
+            except Exception as e:
+                outcomes[queue.name] = e
+        threads = [threading.Thread(target = run, args = (queue,)) for queue in (failing, passing)]
+        try:
+            for thread in threads:
+                thread.start()
+                time.sleep(0.05)
+            for thread in threads:
+                thread.join(20)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+        finally:
+            pool.shutdown()
+        self.assertIsInstance(outcomes['failing'], ValueError)
+        self.assertEqual(outcomes['passing'], list(range(8)))
+
+    def test_failing_queue_leaves_concurrent_queue_running_on_processes(self):
+        self.run_concurrent_queues('process')
+
+    def test_failing_queue_leaves_concurrent_queue_running_on_threads(self):
+        self.run_concurrent_queues('thread')
+
+    def test_concurrent_queues_share_workers(self):
+        pool = WorkerPool(2, 'thread')
+        queues = [ParallelTaskQueue(str(n), pool, [sleep_and_count() for _ in range(4)]) for n in range(3)]
+        threads = [threading.Thread(target = queue.run) for queue in queues]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(20)
+        finally:
+            pool.shutdown()
+        self.assertEqual(running['most'], 2)
+
+    def test_worker_forked_while_database_is_locked(self):
+        saved_instance = BuildDatabase._instance
+        db = BuildDatabase._instance = BuildDatabase(os.path.join(tempfile.mkdtemp(), 'db'))
+        locked, release = threading.Event(), threading.Event()
+        def hold_lock():
+            with db.lock:
+                locked.set()
+                release.wait()
+        holder = threading.Thread(target = hold_lock)
+        holder.start()
+        locked.wait()
+        pool = WorkerPool(1, 'process')
+        queue = ParallelTaskQueue('queue', pool, [complete_in_database('/tmp/output')])
+        outcomes = []
+        runner = threading.Thread(target = lambda: outcomes.append(queue.run()), daemon = True)
+        try:
+            runner.start()
+            runner.join(10)
+        finally:
+            release.set()
+            holder.join()
+            if runner.is_alive():
+                pool.cancel()
+            pool.shutdown()
+            BuildDatabase._instance = saved_instance
+        self.assertEqual(outcomes, [[True]])
+
+#--------------------------------------------------------------------
+class EvictingObjectCache(ObjectCache):
+    """
+        Evicts every entry just before materializing a hit, as another
+        process sharing the cache directory might.
+    """
+    def _materialize(self, src, dest):
+        self.clear()
+        super()._materialize(src, dest)
+
+#--------------------------------------------------------------------
+class ObjectCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output = File(os.path.join(self.dir, 'a.o'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def build(self, cache, text):
+        def compile():
+            with open(self.output.abspath(), 'w') as outfile:
+                outfile.write(text)
+        hit = cache.run('ab' * 32, [self.output], compile)
+        with open(self.output.abspath(), 'r') as infile:
+            return hit, infile.read()
+
+    def test_hit_restores_stored_output(self):
+        cache = ObjectCache(os.path.join(self.dir, 'cache'))
+        self.assertEqual(self.build(cache, 'stored'), (False, 'stored'))
+        self.assertEqual(self.build(cache, 'rebuilt'), (True, 'stored'))
+
+    def test_entry_evicted_during_fetch_is_a_miss(self):
+        cache = EvictingObjectCache(os.path.join(self.dir, 'cache'))
+        self.assertEqual(self.build(cache, 'stored'), (False, 'stored'))
+        self.assertEqual(self.build(cache, 'rebuilt'), (False, 'rebuilt'))
+        self.assertEqual(cache.stats()['hits'], 0)
+
+#--------------------------------------------------------------------
+@unittest.skipUnless(shutil.which('g++'), 'g++ is not installed.')
+class CppRecipeTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved_instance = BuildDatabase._instance
+        self.saved_cache = FileTask.cache
+        BuildDatabase._instance = BuildDatabase(self.path('.bakery', 'db'))
+        FileTask.cache = SharedCache(self.path('cache'))
+        self.config = cpp.Config()
+        self.config.CXX = 'g++'
+        stat_cache.clear()
+
+    def tearDown(self):
+        BuildDatabase._instance = self.saved_instance
+        FileTask.cache = self.saved_cache
+        stat_cache.clear()
+        shutil.rmtree(self.dir)
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def write(self, name, text):
+        with open(self.path(name), 'w') as outfile:
+            outfile.write(text)
+        stat_cache.clear()
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as infile:
+            return infile.read()
+
+    def test_unity_object_with_shared_cache(self):
+        self.write('a.cpp', 'int a() { return 1; }\n')
+        self.write('b.cpp', 'int b() { return 2; }\n')
+        sources = [self.path('a.cpp'), self.path('b.cpp')]
+        cpp.UnityObjectMaker(self.path('unity', 'u.cpp'), sources, self.config)()
+        built = self.read(os.path.join('unity', 'u.o'))
+        shutil.rmtree(self.path('unity'))
+        stat_cache.clear()
+        cpp.UnityObjectMaker(self.path('unity', 'u.cpp'), sources, self.config)()
+        self.assertEqual(self.read(os.path.join('unity', 'u.o')), built)
+        self.assertEqual(FileTask.cache.hits, 1)
+
+    def test_precompiled_header_change_misses_shared_cache(self):
+        self.write('a.cpp', 'int a() { return VALUE; }\n')
+        objects = []
+        for value in (1, 2):
+            self.write('common.h', '#define VALUE %d\n' % value)
+            self.config.pch = cpp.PchMaker(self.path('common.h'), self.config)
+            self.config.pch()
+            cpp.ObjectMaker(self.path('a.cpp'), self.config)()
+            objects.append(self.read('a.o'))
+        self.assertNotEqual(objects[0], objects[1])
+        self.assertEqual(FileTask.cache.hits, 0)
+
+#--------------------------------------------------------------------
+# A job which records the pid of the worker running it in 'out.txt'.
+WORKER_PID_JOB = [sys.executable, '-c',
+    'import os, sys, time; time.sleep(float(sys.argv[1])); open("out.txt", "w").write(str(os.getppid()))']
+
+#--------------------------------------------------------------------
+class RemoteTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.kill()
+            worker.wait()
+            worker.stdout.close()
+        shutil.rmtree(self.dir)
+
+    def start_worker(self, jobs):
+        """
+            Starts a bake-worker on a free port of localhost, returning
+            its process and address.
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+            os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH')]))
+        worker = subprocess.Popen([sys.executable, '-u', '-m', 'bakery.remote', '-P', '0', '-j', str(jobs)],
+                                  stdout = subprocess.PIPE, env = env)
+        self.workers.append(worker)
+        port = int(worker.stdout.readline().split()[3].decode('utf-8').rsplit(':', 1)[1])
+        return worker, ('127.0.0.1', port)
+
+    def run_job(self, executor, name, delay = 0):
+        output = os.path.join(self.dir, name)
+        executor.execute(WORKER_PID_JOB + [str(delay)], {}, {'out.txt': output})
+        with open(output, 'r') as infile:
+            return int(infile.read())
+
+    def run_jobs(self, executor, count, delay):
+        pids = {}
+        threads = [threading.Thread(target = lambda n: pids.update({n: self.run_job(executor, str(n), delay)}),
+                                    args = (n,), daemon = True) for n in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        return sorted(pids.values())
+
+    def test_default_timeout_is_finite(self):
+        executor = RemoteExecutor([])
+        self.assertIsNotNone(executor.timeout)
+        self.assertIsNotNone(executor.connect_timeout)
+
+    def test_jobs_are_dispatched_by_capacity(self):
+        small, small_address = self.start_worker(1)
+        large, large_address = self.start_worker(2)
+        executor = RemoteExecutor([small_address, large_address])
+        self.assertEqual(executor.capacity(), 3)
+        self.assertEqual(self.run_jobs(executor, 3, 1), sorted([small.pid, large.pid, large.pid]))
+
+    def test_unresponsive_worker_is_unavailable(self):
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen()
+            executor = RemoteExecutor([listener.getsockname()], connect_timeout = 0.5)
+        self.assertEqual(executor.workers, [])
+
+    def test_lost_worker_is_retried_elsewhere(self):
+        victim, victim_address = self.start_worker(2)
+        survivor, survivor_address = self.start_worker(1)
+        executor = RemoteExecutor([victim_address, survivor_address])
+        # The job goes to the worker with the most free slots, which
+        # is killed while it runs.
+        killer = threading.Timer(0.5, victim.kill)
+        killer.start()
+        self.assertEqual(self.run_job(executor, 'out', 2), survivor.pid)
+        killer.join()
+        self.assertEqual([worker.alive for worker in executor.workers], [False, True])
+        self.assertEqual(executor.capacity(), 1)
+
+    def test_falls_back_to_local_execution(self):
+        worker, address = self.start_worker(1)
+        executor = RemoteExecutor([address])
+        worker.kill()
+        worker.wait()
+        with self.assertRaises(RemoteError):
+            self.run_job(executor, 'remote')
+        output = File(os.path.join(self.dir, 'out.txt'))
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            self.assertEqual(executor.shell(WORKER_PID_JOB, '0', outputs = [output]), 0)
+        finally:
+            os.chdir(cwd)
+        with open(output.abspath(), 'r') as infile:
+            self.assertEqual(int(infile.read()), os.getpid())
+
+#--------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()